@@ -0,0 +1,74 @@
+"""
+Benchmark of building and validating large task graphs.
+
+Times graph construction, cycle detection, topological sort, levels,
+scheduler setup and optimize on a long chain and on random DAGs. Run it
+from the repository root:
+
+    python benchmarks/bench_graph.py [number of tasks]
+"""
+import sys
+import time
+import random
+
+sys.path.insert(0, '.')
+
+from gtui.task import Task, TaskGraph  # noqa: E402
+from gtui.scheduler import Scheduler  # noqa: E402
+
+
+def noop():
+    pass
+
+
+def chain(n):
+    tasks = [Task('task{}'.format(i), noop) for i in range(n)]
+    return TaskGraph.linear_graph_from_list(tasks)
+
+
+def random_dag(n, edges_per_task=3, window=None, seed=0):
+    """Each task waits for random earlier tasks, among the window tasks before it if given"""
+    rand = random.Random(seed)
+    tasks = [Task('task{}'.format(i), noop) for i in range(n)]
+    graph = TaskGraph()
+    for i, task in enumerate(tasks):
+        # Only wait for earlier tasks so that there's no cycle
+        low = 0 if window is None else max(0, i - window)
+        waiting_for = [tasks[rand.randrange(low, i)] for _ in range(min(i, edges_per_task))]
+        graph.add_task(task, waiting_for=waiting_for)
+    return graph
+
+
+def timed(func):
+    start = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - start
+
+
+def bench(name, build):
+    graph, build_time = timed(build)
+    steps = [
+        ('build', build_time),
+        ('has_cycle', timed(graph.has_cycle)[1]),
+        ('topological_order', timed(graph.topological_order)[1]),
+        ('levels', timed(graph.levels)[1]),
+        ('scheduler', timed(lambda: Scheduler(graph))[1]),
+    ]
+    report, elapsed = timed(graph.optimize)
+    steps.append(('optimize', elapsed))
+    print('{} ({} tasks)'.format(name, len(graph.tasks)))
+    for step, elapsed in steps:
+        print('    {:<20} {:>8.3f}s'.format(step, elapsed))
+    print('    {} redundant edges removed'.format(report['removed_edges']))
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    bench('chain', lambda: chain(n))
+    bench('random DAG, local edges', lambda: random_dag(n, window=100))
+    # Transitive reduction visits most ancestors of each task here, so optimize is much slower
+    bench('random DAG', lambda: random_dag(n))
+
+
+if __name__ == '__main__':
+    main()
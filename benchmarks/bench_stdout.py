@@ -0,0 +1,61 @@
+"""
+Microbenchmark of print() throughput inside a task.
+
+Compares the werkzeug LocalProxy gtui used to install as sys.stdout with
+gtui.output.StdoutRouter, with and without write batching, all writing to
+an OutputBuffer. Run it from the repository root:
+
+    python benchmarks/bench_stdout.py [number of prints]
+"""
+import sys
+import time
+import contextvars
+
+sys.path.insert(0, '.')
+
+from gtui.output import OutputBuffer, BatchedWriter, StdoutRouter  # noqa: E402
+from gtui.utils.werkzeug_local import LocalProxy  # noqa: E402
+
+
+def local_proxy(current):
+    return LocalProxy(lambda: current.get(sys.__stdout__))
+
+
+def stdout_router(current):
+    return StdoutRouter(current, sys.__stdout__)
+
+
+def bench(make_router, make_target, n):
+    current = contextvars.ContextVar('stdout')
+    buffer = OutputBuffer()
+    target = make_target(buffer)
+    current.set(target)
+    stdout = make_router(current)
+
+    start = time.perf_counter()
+    for i in range(n):
+        print('line', i, file=stdout)
+    target.flush()
+    elapsed = time.perf_counter() - start
+
+    assert buffer.getvalue().count('\n') == n
+    return elapsed
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    cases = [
+        ('LocalProxy', local_proxy, lambda buffer: buffer),
+        ('StdoutRouter', stdout_router, lambda buffer: buffer),
+        ('StdoutRouter + batching', stdout_router, lambda buffer: BatchedWriter(buffer, 1 << 12)),
+    ]
+    baseline = None
+    for name, make_router, make_target in cases:
+        elapsed = min(bench(make_router, make_target, n) for _ in range(3))
+        baseline = baseline or elapsed
+        print('{:<25} {:>8.3f}s {:>10.0f} prints/s {:>6.2f}x'.format(
+            name, elapsed, n / elapsed, baseline / elapsed))
+
+
+if __name__ == '__main__':
+    main()
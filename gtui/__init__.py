@@ -1,6 +1,7 @@
 """Simple Job Scheduler With Friendly Text User Interface"""
-from .task import Task, TaskGraph
+from .task import Task, ShellTask, TaskGraph
 from .executor import IORedirectedThread
+from .headless import HeadlessRunner
 from . import callback
 
 __version__ = '0.1.1'
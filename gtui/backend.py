@@ -0,0 +1,710 @@
+"""
+Execution backends used by the executor.
+
+A backend receives ready tasks from the executor and decides where they run.
+It reports what happens back to the executor with these methods:
+
+    executor.run_task(task)                          run in current thread & report
+    executor.run_task_async(task)                    coroutine to run in event loop & report
+    executor.write_task_output(task, text)           append text to task stdout
+    executor.add_task_log_record(task, record)       collect a log record of task
+    executor.finish_task(task, error, tb)            report task is finished
+"""
+import os
+import sys
+import codecs
+import locale
+import pickle
+import logging
+import selectors
+import threading
+import traceback
+import subprocess
+import multiprocessing
+import multiprocessing.connection
+from collections import deque
+
+from .utils import picklable_log_record
+
+logger = logging.getLogger(__name__)
+
+
+class Backend:
+    """Base class of execution backends"""
+
+    # Maximum number of tasks the backend runs at the same time, None means no limit.
+    # The scheduler doesn't start more tasks of the backend than it.
+    max_workers = None
+
+    def start(self, executor):
+        """Called once before any task is submitted"""
+        self.executor = executor
+
+    def submit(self, task):
+        """Run a task asynchronously, executor.finish_task must be called when it's done"""
+        raise NotImplementedError
+
+    def shutdown(self):
+        """Called when no task is running and no more task will be submitted"""
+
+
+class TaskThreadPool:
+    """A pool of reusable worker threads fed by a queue of ready tasks.
+
+    Threads are created lazily, only when a task is submitted and no idle
+    worker can pick it, and there will be at most max_workers of them.
+    """
+
+    def __init__(self, run_task, max_workers=None, name='gtui-worker'):
+        """
+        Parameters
+        ----------
+        run_task : function
+            A function accepting a task, called in worker threads.
+        max_workers : int
+            Maximum number of worker threads. Defaults to None meaning no limit.
+        name : str
+            Prefix of worker thread names.
+        """
+        if max_workers is not None and max_workers < 1:
+            raise ValueError('max_workers must be greater than 0, got {}'.format(max_workers))
+
+        self.run_task = run_task
+        self.max_workers = max_workers
+        self.name = name
+        self.threads = []
+        self.pending = deque()
+        self.num_idle = 0
+        self.is_shutdown = False
+        self.condition = threading.Condition()
+
+    def submit(self, task):
+        with self.condition:
+            self.pending.append(task)
+            if self.num_idle >= len(self.pending):
+                self.condition.notify()
+            elif self.max_workers is None or len(self.threads) < self.max_workers:
+                thread = threading.Thread(
+                    target=self.work,
+                    name='{}-{}'.format(self.name, len(self.threads)),
+                    daemon=True
+                )
+                self.threads.append(thread)
+                thread.start()
+
+    def work(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.is_shutdown:
+                    self.num_idle += 1
+                    self.condition.wait()
+                    self.num_idle -= 1
+                if not self.pending:
+                    return
+                task = self.pending.popleft()
+            self.run_task(task)
+
+    def shutdown(self):
+        """Let idle workers exit, tasks already submitted will still be run"""
+        with self.condition:
+            self.is_shutdown = True
+            self.condition.notify_all()
+
+
+class ThreadBackend(Backend):
+    """Run tasks in a pool of threads of current process"""
+
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers
+        self.pool = None
+
+    def start(self, executor):
+        super().start(executor)
+        self.pool = TaskThreadPool(executor.run_task, max_workers=self.max_workers)
+
+    def submit(self, task):
+        self.pool.submit(task)
+
+    def shutdown(self):
+        self.pool.shutdown()
+
+
+class _PipeWriter:
+    """A file-like object sending written text through a connection, line buffered"""
+
+    def __init__(self, conn, lock, buffer_size=8192):
+        self.conn = conn
+        self.send_lock = lock
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.size = 0
+
+    def write(self, s):
+        self.buffer.append(s)
+        self.size += len(s)
+        if self.size >= self.buffer_size or '\n' in s:
+            self.flush()
+        return len(s)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        if not self.buffer:
+            return
+        text = ''.join(self.buffer)
+        self.buffer = []
+        self.size = 0
+        with self.send_lock:
+            self.conn.send(('stdout', text))
+
+    def isatty(self):
+        return False
+
+
+class _PipeLogHandler(logging.Handler):
+    """Send log records through a connection, records are made picklable first"""
+
+    def __init__(self, conn, lock):
+        super().__init__()
+        self.conn = conn
+        self.send_lock = lock
+
+    def emit(self, record):
+        try:
+            record = picklable_log_record(record)
+            with self.send_lock:
+                self.conn.send(('log', record))
+        except Exception:
+            self.handleError(record)
+
+
+def _picklable_error(e):
+    try:
+        pickle.dumps(e)
+        return e
+    except Exception:
+        return RuntimeError(repr(e))
+
+
+# Written to the captured file descriptors of a worker process after each task,
+# so that the reader knows all output of the task has been read
+_TASK_END_MARKER = b'\0gtui-task-end\0'
+
+
+def _process_worker(conn, output_conn=None):
+    """Main loop of a worker process, run tasks received from conn until None is received
+
+    If output_conn is given, file descriptors 1 & 2 are redirected to it so that
+    output of C extensions and child processes is captured as well.
+    """
+    lock = threading.Lock()
+    if output_conn is None:
+        stdout = _PipeWriter(conn, lock)
+        sys.stdout = stdout
+    else:
+        os.dup2(output_conn.fileno(), 1)
+        os.dup2(output_conn.fileno(), 2)
+        output_conn.close()
+        stdout = sys.stdout = open(1, 'w', buffering=1, closefd=False)
+        sys.stderr = open(2, 'w', buffering=1, closefd=False)
+    logging.root.handlers = [_PipeLogHandler(conn, lock)]
+    logging.root.setLevel(logging.DEBUG)
+
+    while True:
+        message = conn.recv()
+        if message is None:
+            return
+
+        # Records below the level of the task are not even created
+        task, log_level = message
+        logging.root.setLevel(log_level)
+
+        error, tb = None, None
+        try:
+            task.run()
+        except BaseException as e:
+            error, tb = _picklable_error(e), traceback.format_exc()
+            logging.debug('Task %s exit with error %s traceback: %s', task.name, e, tb)
+
+        stdout.flush()
+        if output_conn is not None:
+            sys.stderr.flush()
+            os.write(1, _TASK_END_MARKER)
+        with lock:
+            conn.send(('done', error, tb))
+
+
+class _CapturedOutput:
+    """Output read from the file descriptors of a worker process, belonging to the task it runs"""
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.task = None
+        self.decoder = None
+        self.pending = b''
+        self.task_end = threading.Event()
+
+    def begin(self, task):
+        self.task = task
+        self.decoder = codecs.getincrementaldecoder(locale.getpreferredencoding(False))(errors='replace')
+        self.task_end.clear()
+
+    def end(self, timeout):
+        """Wait until output of current task is read, returns False on timeout"""
+        is_read = self.task_end.wait(timeout)
+        self.task = None
+        return is_read
+
+
+class FdReader:
+    """Read output of many worker processes in a single thread with a selector.
+
+    Each worker has a pipe as its stdout & stderr. Data read from the pipe is
+    decoded and written to the output of the task the worker is running.
+    """
+
+    READ_SIZE = 65536
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.selector = selectors.DefaultSelector()
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        os.set_blocking(self.wakeup_w, False)
+        self.selector.register(self.wakeup_r, selectors.EVENT_READ)
+        self.new_outputs = []
+        self.is_shutdown = False
+        self.thread = None
+        self.executor = None
+
+    def start(self, executor):
+        self.executor = executor
+        self.thread = threading.Thread(target=self.loop, name='gtui-fd-reader', daemon=True)
+        self.thread.start()
+
+    def add(self, fd):
+        """Start reading fd, returns a _CapturedOutput to tell which task the output belongs to"""
+        os.set_blocking(fd, False)
+        output = _CapturedOutput(fd)
+        with self.lock:
+            self.new_outputs.append(output)
+            self.wakeup()
+        return output
+
+    def wakeup(self):
+        """Wake up the loop thread, must be called with lock held"""
+        try:
+            os.write(self.wakeup_w, b'\0')
+        except BlockingIOError:
+            pass  # Loop thread is already going to wake up
+
+    def loop(self):
+        while True:
+            with self.lock:
+                # Only the wakeup pipe is left when all worker processes exited
+                if self.is_shutdown and not self.new_outputs and len(self.selector.get_map()) == 1:
+                    break
+            for key, _ in self.selector.select():
+                if key.fd == self.wakeup_r:
+                    os.read(self.wakeup_r, self.READ_SIZE)
+                    with self.lock:
+                        new_outputs, self.new_outputs = self.new_outputs, []
+                    for output in new_outputs:
+                        self.selector.register(output.fd, selectors.EVENT_READ, output)
+                else:
+                    self.read(key.data)
+
+        self.selector.close()
+        os.close(self.wakeup_r)
+        os.close(self.wakeup_w)
+
+    def read(self, output):
+        try:
+            data = os.read(output.fd, self.READ_SIZE)
+        except BlockingIOError:
+            return
+        if not data:
+            # Worker process exited
+            self.selector.unregister(output.fd)
+            os.close(output.fd)
+            self.write(output, output.pending, final=True)
+            output.task_end.set()
+            return
+
+        data = output.pending + data
+        output.pending = b''
+        while True:
+            index = data.find(_TASK_END_MARKER)
+            if index == -1:
+                break
+            self.write(output, data[:index], final=True)
+            output.task_end.set()
+            data = data[index + len(_TASK_END_MARKER):]
+
+        # Keep a tail which may be the beginning of a marker
+        for size in range(min(len(data), len(_TASK_END_MARKER) - 1), 0, -1):
+            if _TASK_END_MARKER.startswith(data[-size:]):
+                data, output.pending = data[:-size], data[-size:]
+                break
+        self.write(output, data)
+
+    def write(self, output, data, final=False):
+        task, decoder = output.task, output.decoder
+        if task is None:
+            if data:
+                logger.debug('Discard output of worker process outside of tasks: %r', data[:100])
+            return
+        text = decoder.decode(data, final=final)
+        if text:
+            self.executor.write_task_output(task, text)
+
+    def shutdown(self):
+        """Let the loop thread exit once all worker processes exit"""
+        with self.lock:
+            self.is_shutdown = True
+            self.wakeup()
+
+
+class ProcessBackend(Backend):
+    """Run tasks in worker processes to make use of multiple cores.
+
+    Each worker process is driven by a thread in current process, which sends
+    tasks to it and receives stdout, log records and result through a pipe.
+    Tasks must be picklable, e.g. func defined at module level.
+    """
+
+    # Seconds to wait for output of a finished task to be read when capturing fds
+    OUTPUT_TIMEOUT = 5
+
+    def __init__(self, max_workers=None, start_method=None, capture_fd=False):
+        """
+        Parameters
+        ----------
+        max_workers : int
+            Number of worker processes. Defaults to the number of cpus.
+        start_method : str
+            'forkserver', 'spawn' or 'fork'. Defaults to 'forkserver' if available else 'spawn'.
+        capture_fd : bool
+            Whether redirect file descriptors 1 & 2 of worker processes to pipes read by
+            a single FdReader thread, so output of C extensions, os.system and child
+            processes is captured too. Defaults to False, only sys.stdout is captured.
+        """
+        if start_method is None:
+            if 'forkserver' in multiprocessing.get_all_start_methods():
+                start_method = 'forkserver'
+            else:
+                start_method = 'spawn'
+
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.context = multiprocessing.get_context(start_method)
+        self.local = threading.local()
+        self.processes = []
+        self.processes_lock = threading.Lock()
+        self.pool = None
+        self.fd_reader = FdReader() if capture_fd else None
+
+    def start(self, executor):
+        super().start(executor)
+        self.pool = TaskThreadPool(self.run_task, max_workers=self.max_workers, name='gtui-process')
+        if self.fd_reader is not None:
+            self.fd_reader.start(executor)
+
+    def submit(self, task):
+        self.pool.submit(task)
+
+    def get_worker(self):
+        """Returns the (process, connection, captured output) owned by current thread, start one if needed"""
+        worker = getattr(self.local, 'worker', None)
+        if worker is None:
+            conn, child_conn = self.context.Pipe()
+            args, output = (child_conn,), None
+            if self.fd_reader is not None:
+                read_fd, write_fd = os.pipe()
+                output_conn = multiprocessing.connection.Connection(write_fd, readable=False)
+                args = (child_conn, output_conn)
+            process = self.context.Process(target=_process_worker, args=args, daemon=True)
+            process.start()
+            child_conn.close()
+            if self.fd_reader is not None:
+                output_conn.close()
+                output = self.fd_reader.add(read_fd)
+            worker = (process, conn, output)
+            self.local.worker = worker
+            with self.processes_lock:
+                self.processes.append(worker)
+        return worker
+
+    def discard_worker(self):
+        process, conn, output = self.local.worker
+        self.local.worker = None
+        with self.processes_lock:
+            self.processes.remove((process, conn, output))
+        conn.close()
+        process.kill()
+
+    def run_task(self, task):
+        error, tb = None, None
+        output = None
+        try:
+            process, conn, output = self.get_worker()
+            if output is not None:
+                output.begin(task)
+            conn.send((task, self.executor.get_task_log_level(task)))
+            while True:
+                kind, *payload = conn.recv()
+                if kind == 'stdout':
+                    self.executor.write_task_output(task, payload[0])
+                elif kind == 'log':
+                    self.executor.add_task_log_record(task, payload[0])
+                elif kind == 'done':
+                    error, tb = payload
+                    break
+            if output is not None and not output.end(self.OUTPUT_TIMEOUT):
+                logger.debug('Timeout waiting for output of task %s', task.name)
+        except BaseException as e:
+            # Unpicklable task or worker process died, start a new one for next task
+            error, tb = e, traceback.format_exc()
+            if getattr(self.local, 'worker', None) is not None:
+                self.discard_worker()
+
+        self.executor.finish_task(task, error, tb)
+
+    def shutdown(self):
+        self.pool.shutdown()
+        with self.processes_lock:
+            for process, conn, output in self.processes:
+                try:
+                    conn.send(None)
+                except OSError:
+                    pass
+            self.processes = []
+        if self.fd_reader is not None:
+            self.fd_reader.shutdown()
+
+
+class _ShellProcess:
+    """Bookkeeping of a running shell task"""
+
+    def __init__(self, task, process):
+        self.task = task
+        self.process = process
+        self.num_open_streams = 2
+        encoding = locale.getpreferredencoding(False)
+        self.fd2decoder = {
+            process.stdout.fileno(): codecs.getincrementaldecoder(encoding)(errors='replace'),
+            process.stderr.fileno(): codecs.getincrementaldecoder(encoding)(errors='replace'),
+        }
+
+
+class ShellBackend(Backend):
+    """Run ShellTask in child processes watched by a single event loop thread.
+
+    The loop thread starts child processes and uses a selector to read their
+    stdout & stderr without blocking, so hundreds of commands can run at the
+    same time with only one thread. Exit code other than 0 means failure.
+    """
+
+    READ_SIZE = 65536
+    # Seconds between polls of processes that closed their stdout & stderr but haven't exited yet
+    REAP_INTERVAL = 0.05
+
+    def __init__(self, max_procs=None):
+        """
+        Parameters
+        ----------
+        max_procs : int
+            Maximum number of child processes at the same time. Defaults to None meaning no limit.
+        """
+        if max_procs is not None and max_procs < 1:
+            raise ValueError('max_procs must be greater than 0, got {}'.format(max_procs))
+
+        self.max_procs = max_procs
+        self.max_workers = max_procs
+        self.pending = deque()
+        self.num_procs = 0
+        self.is_shutdown = False
+        self.lock = threading.Lock()
+        self.thread = None
+        self.selector = None
+        self.wakeup_r, self.wakeup_w = None, None
+        # _ShellProcess whose output is all read, waiting for them to exit
+        self.exiting = []
+
+    def submit(self, task):
+        with self.lock:
+            self.pending.append(task)
+            if self.thread is None:
+                self.selector = selectors.DefaultSelector()
+                self.wakeup_r, self.wakeup_w = os.pipe()
+                os.set_blocking(self.wakeup_w, False)
+                self.selector.register(self.wakeup_r, selectors.EVENT_READ)
+                self.thread = threading.Thread(target=self.loop, name='gtui-shell', daemon=True)
+                self.thread.start()
+            self.wakeup()
+
+    def wakeup(self):
+        """Wake up the loop thread, must be called with lock held"""
+        try:
+            os.write(self.wakeup_w, b'\0')
+        except BlockingIOError:
+            pass  # Loop thread is already going to wake up
+
+    def loop(self):
+        while True:
+            for key, _ in self.selector.select(self.REAP_INTERVAL if self.exiting else None):
+                if key.fd == self.wakeup_r:
+                    os.read(self.wakeup_r, self.READ_SIZE)
+                else:
+                    self.read(key.fd, key.data)
+            if self.exiting:
+                self.reap()
+
+            tasks = []
+            with self.lock:
+                if self.is_shutdown and self.num_procs == 0:
+                    break
+                while self.pending and (self.max_procs is None or self.num_procs < self.max_procs):
+                    tasks.append(self.pending.popleft())
+                    self.num_procs += 1
+
+            for task in tasks:
+                self.spawn(task)
+
+        self.selector.close()
+        os.close(self.wakeup_r)
+        os.close(self.wakeup_w)
+
+    def spawn(self, task):
+        try:
+            process = task.popen(stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except Exception as e:
+            with self.lock:
+                self.num_procs -= 1
+            self.executor.finish_task(task, e, traceback.format_exc())
+            return
+
+        shell_process = _ShellProcess(task, process)
+        for stream in (process.stdout, process.stderr):
+            os.set_blocking(stream.fileno(), False)
+            self.selector.register(stream.fileno(), selectors.EVENT_READ, shell_process)
+
+    def read(self, fd, shell_process):
+        decoder = shell_process.fd2decoder[fd]
+        try:
+            data = os.read(fd, self.READ_SIZE)
+        except BlockingIOError:
+            return
+
+        text = decoder.decode(data, final=not data)
+        if text:
+            self.executor.write_task_output(shell_process.task, text)
+        if data:
+            return
+
+        self.selector.unregister(fd)
+        shell_process.num_open_streams -= 1
+        if shell_process.num_open_streams == 0:
+            shell_process.process.stdout.close()
+            shell_process.process.stderr.close()
+            self.exiting.append(shell_process)
+
+    def reap(self):
+        """Finish tasks whose process has exited, without blocking on the others"""
+        exiting = []
+        for shell_process in self.exiting:
+            if shell_process.process.poll() is None:
+                exiting.append(shell_process)
+            else:
+                self.exit(shell_process)
+        self.exiting = exiting
+
+    def exit(self, shell_process):
+        task, returncode = shell_process.task, shell_process.process.returncode
+        with self.lock:
+            self.num_procs -= 1
+
+        error = None
+        if returncode != 0:
+            error = subprocess.CalledProcessError(returncode, task.argv)
+        record = logger.makeRecord(
+            logger.name, logging.DEBUG if error is None else logging.ERROR, __file__, 0,
+            'Task %s exit with code %s', (task.name, returncode), None
+        )
+        self.executor.add_task_log_record(task, record)
+        self.executor.finish_task(task, error, None)
+
+    def shutdown(self):
+        with self.lock:
+            self.is_shutdown = True
+            if self.thread is not None:
+                self.wakeup()
+
+
+class AsyncioBackend(Backend):
+    """Run tasks of async functions as coroutines on a single event loop thread"""
+
+    def __init__(self, max_tasks=None):
+        """
+        Parameters
+        ----------
+        max_tasks : int
+            Maximum number of coroutine tasks at the same time. Defaults to None meaning no limit.
+        """
+        if max_tasks is not None and max_tasks < 1:
+            raise ValueError('max_tasks must be greater than 0, got {}'.format(max_tasks))
+
+        self.max_tasks = max_tasks
+        self.max_workers = max_tasks
+        self.loop = None
+        self.thread = None
+        self.semaphore = None
+        self.lock = threading.Lock()
+
+    def submit(self, task):
+        import asyncio  # Imported lazily, it's slow to import and most graphs don't need it
+
+        with self.lock:
+            if self.thread is None:
+                self.loop = asyncio.new_event_loop()
+                self.thread = threading.Thread(target=self.run_loop, name='gtui-asyncio', daemon=True)
+                self.thread.start()
+            self.loop.call_soon_threadsafe(self.start_task, task)
+
+    def run_loop(self):
+        import asyncio
+
+        asyncio.set_event_loop(self.loop)
+        if self.max_tasks is not None:
+            self.semaphore = asyncio.Semaphore(self.max_tasks)
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.close()
+
+    def start_task(self, task):
+        # Each asyncio task runs in its own copy of context so output is separated
+        self.loop.create_task(self.run_task(task))
+
+    async def run_task(self, task):
+        if self.semaphore is None:
+            await self.executor.run_task_async(task)
+            return
+        async with self.semaphore:
+            await self.executor.run_task_async(task)
+
+    def shutdown(self):
+        with self.lock:
+            if self.thread is not None:
+                self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+def get_backend(backend=None, max_workers=None, capture_fd=False):
+    """Returns a Backend instance given a name ('thread', 'process') or a Backend instance"""
+    if isinstance(backend, Backend):
+        return backend
+    if backend is None or backend == 'thread':
+        return ThreadBackend(max_workers=max_workers)
+    if backend == 'process':
+        return ProcessBackend(max_workers=max_workers, capture_fd=capture_fd)
+    raise ValueError('Unknown backend {!r}, should be "thread", "process" or a Backend instance'.format(backend))
@@ -0,0 +1,192 @@
+"""
+A result cache to skip tasks whose inputs have not changed, like make.
+
+A task is identified by a fingerprint computed from its function (qualified
+name, a hash of its code, its default args, closure variables and bound
+object), args, kwargs, declared input files (size and mtime) and the
+fingerprints of the tasks it waits for. When a fingerprint is
+found in the cache, the task is marked as succeeded right away and its
+stdout & log records of the cached run are replayed.
+
+Entries are stored as files on local disk, least recently used entries are
+evicted when total size exceeds the limit.
+"""
+import os
+import types
+import pickle
+import hashlib
+import logging
+import tempfile
+import threading
+
+from .task import FusedTask
+from .utils import picklable_log_record
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'gtui')
+DEFAULT_MAX_SIZE = 1024 ** 3  # 1 GiB
+
+
+def _hash_code(code: types.CodeType, sha):
+    sha.update(code.co_code)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            _hash_code(const, sha)
+        else:
+            sha.update(repr(const).encode())
+    sha.update(repr(code.co_names).encode())
+
+
+def _hash_func(func, sha):
+    sha.update('{}.{}'.format(
+        getattr(func, '__module__', None),
+        getattr(func, '__qualname__', repr(func))
+    ).encode())
+    code = getattr(func, '__code__', None)
+    if code is not None:
+        _hash_code(code, sha)
+
+    # Closures and bound methods with different state share the same code,
+    # raises if any of it can't be pickled
+    cells = []
+    for cell in getattr(func, '__closure__', None) or ():
+        try:
+            cells.append(cell.cell_contents)
+        except ValueError:  # empty cell
+            cells.append(None)
+    bound = getattr(func, '__self__', None)
+    if isinstance(bound, types.ModuleType):  # builtin functions
+        bound = None
+    state = (getattr(func, '__defaults__', None), getattr(func, '__kwdefaults__', None), cells, bound)
+    sha.update(pickle.dumps(state, protocol=4))
+
+
+def task_fingerprint(task, upstream_fingerprints=()):
+    """Returns a hex digest identifying task & its inputs, or None if task can't be cached"""
+    if isinstance(task, FusedTask):
+        return _fused_task_fingerprint(task, upstream_fingerprints)
+
+    sha = hashlib.sha256()
+    try:
+        _hash_func(task.func, sha)
+        sha.update(pickle.dumps((task.args, sorted(task.kwargs.items())), protocol=4))
+    except Exception:
+        return None
+
+    for path in task.inputs:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        sha.update('{}:{}:{}'.format(path, stat.st_size, stat.st_mtime_ns).encode())
+
+    for fingerprint in sorted(upstream_fingerprints):
+        sha.update(fingerprint.encode())
+    return sha.hexdigest()
+
+
+def _fused_task_fingerprint(task, upstream_fingerprints):
+    """Fingerprint of a FusedTask from the ones of its tasks, each one being upstream of the next.
+
+    Functions are pickled by reference, so the fused task itself can't tell
+    when the code of one of its tasks changes.
+    """
+    sha = hashlib.sha256(b'gtui.FusedTask')
+    for sub_task in task.tasks:
+        fingerprint = task_fingerprint(sub_task, upstream_fingerprints)
+        if fingerprint is None:
+            return None
+        sha.update(fingerprint.encode())
+        upstream_fingerprints = [fingerprint]
+    return sha.hexdigest()
+
+
+class ResultCache:
+    """Store stdout & log records of succeeded tasks on disk, keyed by fingerprint"""
+
+    def __init__(self, path=DEFAULT_CACHE_DIR, max_size=DEFAULT_MAX_SIZE):
+        """
+        Parameters
+        ----------
+        path : str
+            directory to store cache entries
+        max_size : int
+            maximum bytes of all entries, least recently used ones are evicted first
+        """
+        self.path = path
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+        # key -> (size, last used time), loaded once and maintained afterwards
+        self.key2entry = {}
+        for name in os.listdir(path):
+            if name.endswith('.pickle'):
+                stat = os.stat(os.path.join(path, name))
+                self.key2entry[name[:-len('.pickle')]] = (stat.st_size, stat.st_mtime)
+        self.total_size = sum(size for size, _ in self.key2entry.values())
+
+    def entry_path(self, key):
+        return os.path.join(self.path, key + '.pickle')
+
+    def get(self, key):
+        """Returns (stdout, log records) of a cached run or None"""
+        with self.lock:
+            if key not in self.key2entry:
+                return None
+            path = self.entry_path(key)
+            try:
+                with open(path, 'rb') as f:
+                    stdout, records = pickle.load(f)
+                os.utime(path)
+            except Exception as e:
+                logger.debug('Failed to load cache entry %s: %s', key, e)
+                self.remove(key)
+                return None
+            self.key2entry[key] = (self.key2entry[key][0], os.stat(path).st_mtime)
+            return stdout, records
+
+    def put(self, key, stdout, records):
+        data = pickle.dumps((stdout, [picklable_log_record(r) for r in records]), protocol=4)
+        with self.lock:
+            if key in self.key2entry:
+                self.remove(key)
+
+            # Write to a temp file then rename, so readers never see half an entry
+            fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, self.entry_path(key))
+
+            self.key2entry[key] = (len(data), os.stat(self.entry_path(key)).st_mtime)
+            self.total_size += len(data)
+            self.evict()
+
+    def remove(self, key):
+        size, _ = self.key2entry.pop(key)
+        self.total_size -= size
+        try:
+            os.remove(self.entry_path(key))
+        except FileNotFoundError:
+            pass
+
+    def evict(self):
+        """Remove least recently used entries until total size is within max_size"""
+        if self.total_size <= self.max_size:
+            return
+        for key in sorted(self.key2entry, key=lambda k: self.key2entry[k][1]):
+            self.remove(key)
+            if self.total_size <= self.max_size:
+                return
+
+
+def get_cache(cache):
+    """Returns a ResultCache given None, True (default dir), a directory or a ResultCache"""
+    if not cache:
+        return None
+    if isinstance(cache, ResultCache):
+        return cache
+    if cache is True:
+        return ResultCache()
+    return ResultCache(path=cache)
@@ -0,0 +1,79 @@
+"""
+Command line entry point, installed as `gtui`, to run a graph spec file.
+
+    gtui pipeline.yaml                         # run with the TUI
+    gtui pipeline.yaml --headless --max-workers 8
+    gtui pipeline.yaml --target report         # run report & the tasks it needs
+
+Options given on the command line override "options" of the spec, see
+gtui.spec for the spec format. The current directory is importable so
+that functions of tasks can be found next to the spec.
+"""
+import os
+import sys
+import argparse
+
+from .spec import load_spec
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='gtui', description='Run a task graph described by a spec file.')
+    parser.add_argument('spec', help='path of a JSON, YAML or TOML graph spec')
+    parser.add_argument('--target', action='append', dest='targets', metavar='TASK',
+                        help='run only this task and the tasks it depends on, can be repeated')
+    parser.add_argument('--headless', action='store_true',
+                        help='run without the TUI, writing status changes of tasks to --event-stream')
+    parser.add_argument('--title', help='title shown at the left bottom corner of the TUI')
+    parser.add_argument('--max-workers', type=int, help='maximum number of tasks running at the same time')
+    parser.add_argument('--backend', choices=['thread', 'process'], help='where to run tasks')
+    parser.add_argument('--policy', choices=['fifo', 'priority', 'critical_path'],
+                        help='order to start ready tasks when --max-workers is reached')
+    parser.add_argument('--resume', help='journal of a previous run, tasks succeeded in it are not run again')
+    parser.add_argument('--log-level', help='log records below this level are not collected')
+    parser.add_argument('--exit-on-success', action='store_true', default=None,
+                        help='exit the TUI if all tasks succeed')
+    parser.add_argument('--event-stream', help='path to write status changes to with --headless, defaults to stderr')
+    parser.add_argument('--event-format', choices=['text', 'json'], help='format of status changes with --headless')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Run the spec given on the command line, returns the exit code"""
+    args = parse_args(argv)
+    if os.getcwd() not in sys.path:
+        sys.path.insert(0, os.getcwd())
+
+    try:
+        graph, options = load_spec(args.spec)
+        if args.targets:
+            graph = graph.subgraph(args.targets)
+    except (OSError, ImportError, ValueError) as e:
+        print('gtui: {}'.format(e), file=sys.stderr)
+        return 2
+
+    for name in ('title', 'max_workers', 'backend', 'policy', 'resume', 'log_level', 'exit_on_success',
+                 'event_stream', 'event_format'):
+        value = getattr(args, name)
+        if value is not None:
+            options[name] = value
+
+    if args.headless:
+        options['ui'] = False
+    results = []
+    if options.get('ui', True):
+        options['callback'] = results.append
+
+    try:
+        returncode = graph.run(**options)
+    except (OSError, ImportError, ValueError, TypeError) as e:
+        # Options of the spec are only checked when the run starts, e.g. an unknown policy
+        print('gtui: {}'.format(e), file=sys.stderr)
+        return 2
+
+    if not options.get('ui', True):
+        return returncode
+    return 0 if results and results[0] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
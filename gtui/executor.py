@@ -4,25 +4,33 @@ An executor to run the task graph.
 It uses mutli-threading to schedule and run the taks according to
 their dependencies defined in the task graph.
 
-Each task is binded to a thread. The output and log records of each
-thread are collected separatedly. The visualizer will query the executor
+Ready tasks are handed to an execution backend, by default a pool of
+reusable worker threads, see gtui.backend. The output and log records
+of each task are collected separatedly, tracked by context variables
+so that coroutine tasks sharing a thread are separated as well. The visualizer will query the executor
 and display these information in TUI to let user know what is going on.
 """
-import io
 import sys
 import logging
 import traceback
 import threading
+import contextvars
 
-from .utils.werkzeug_local import Local, LocalProxy
-from .task import Task, TaskGraph, TaskStatus
+from .task import Task, ShellTask, FusedTask, TaskGraph, TaskStatus
+from .scheduler import Scheduler, SchedulePolicy
+from .backend import get_backend, ShellBackend, AsyncioBackend
+from .cache import get_cache, task_fingerprint
+from .journal import get_journal, load_succeeded_task_names
+from .output import OutputBuffer, BatchedWriter, StdoutRouter, DEFAULT_MAX_MEMORY
+from .logstore import StringTable, LogRecordStore, RecordFilter, get_level_number, DEFAULT_MAX_RECORDS
 
-_local = Local()
-sys.stdout = LocalProxy(lambda: getattr(_local, 'stdout', sys.__stdout__))
+_current_stdout = contextvars.ContextVar('gtui_stdout')
+_current_task_name = contextvars.ContextVar('gtui_task_name')
+sys.stdout = StdoutRouter(_current_stdout, sys.__stdout__)
 
 
 class IORedirectedThread(threading.Thread):
-    """A Thread subclass which replace the sys.stdout with a StringIO when running"""
+    """A Thread subclass which replace the sys.stdout with an OutputBuffer when running"""
 
     def __init__(self, group=None, target=None, name=None, args=(), kwargs=None, *,
                  daemon=None, callback=None, callback_args=(), callback_kwargs=None):
@@ -30,13 +38,13 @@ class IORedirectedThread(threading.Thread):
         self.parent = threading.current_thread()
         self.error = None
         self.traceback = None
-        self.str_stdout = io.StringIO()
+        self.str_stdout = OutputBuffer()
         self.callback = callback
         self.callback_args = callback_args
         self.callback_kwargs = callback_kwargs or {}
 
     def run(self):
-        setattr(_local, 'stdout', self.str_stdout)
+        _current_stdout.set(self.str_stdout)
         try:
             threading.Thread.run(self)
         except BaseException as e:
@@ -66,36 +74,83 @@ class IORedirectedThread(threading.Thread):
         return self.str_stdout.getvalue()
 
 class SeparateThreadLogCollector:
-    """Register log handler. Separate & collect logs for each thread."""
+    """Register log handler. Separate & collect logs for each task or thread.
+
+    Records are kept in a compact gtui.logstore.LogRecordStore for each task or thread,
+    holding at most max_records records. Records of a task can be rejected early by
+    its gtui.logstore.RecordFilter, records below level are not created at all.
+    """
 
     name2records = {}
 
-    def __init__(self):
+    def __init__(self, max_records=DEFAULT_MAX_RECORDS, level=logging.DEBUG):
+        self.max_records = max_records
+        self.level = level
+        self.strings = StringTable()
         self.name2records = {}
+        self.name2filter = {}
+        self.lock = threading.Lock()
 
     def init_log_setting(self):
         collector = self
 
         class SeparateByThreadNameHandler(logging.Handler):
             def emit(self, record: logging.LogRecord):
-                collector.name2records.setdefault(record.threadName, [])
-                collector.name2records[record.threadName].append(record)
+                try:
+                    collector.add_record(_current_task_name.get(record.threadName), record)
+                except Exception:
+                    self.handleError(record)
 
         logging.root.handlers = []
         logging.root.addHandler(SeparateByThreadNameHandler())
-        logging.root.setLevel(logging.DEBUG)
+        logging.root.setLevel(self.level)
+
+    def set_filter(self, name, record_filter: RecordFilter):
+        self.name2filter[name] = record_filter
+
+    def get_num_suppressed_records(self, name):
+        record_filter = self.name2filter.get(name)
+        return 0 if record_filter is None else record_filter.num_suppressed
+
+    def get_store(self, name):
+        store = self.name2records.get(name)
+        if store is None:
+            with self.lock:
+                store = self.name2records.setdefault(name, LogRecordStore(self.strings, self.max_records))
+        return store
+
+    def add_record(self, name, record):
+        record_filter = self.name2filter.get(name)
+        if record_filter is not None and not record_filter.accept(record):
+            return
+        self.get_store(name).append(record)
 
     def get_thread_log_records(self, name):
-        return self.name2records.get(name, [])
+        return self.read_thread_log_records_since(name, 0)[0]
+
+    def read_thread_log_records_since(self, name, start):
+        """Returns records of a task or thread from index start and the index after them"""
+        store = self.name2records.get(name)
+        if store is None:
+            return [], 0
+        return store.read_since(start)
+
+    def get_num_dropped_records(self, name):
+        store = self.name2records.get(name)
+        return 0 if store is None else store.num_dropped
 
     def get_main_thread_log_records(self):
-        return self.name2records.get(threading.main_thread().name, [])
+        return self.get_thread_log_records(threading.main_thread().name)
 
 
 class Executor:
-    """Given a TaskGraph, schedule & run & record log of the tasks. Using mutlithreading."""
+    """Given a TaskGraph, schedule & run & record log of the tasks. Using a thread pool by default."""
 
-    def __init__(self, graph: TaskGraph, callback=None):
+    def __init__(self, graph: TaskGraph, callback=None, max_workers=None, backend=None,
+                 policy=SchedulePolicy.Fifo, durations=None, resources=None, cache=None,
+                 journal=None, resume=None, max_output_memory=DEFAULT_MAX_MEMORY,
+                 max_log_records=DEFAULT_MAX_RECORDS, log_level=logging.DEBUG, log_rate_limit=None,
+                 stdout_batch_size=None, capture_fd=False):
         """Initialize an executor with a task graph and an optional callback functon
 
         Parameters
@@ -107,78 +162,331 @@ class Executor:
             A function which accepts a boolean as parameter. It will be called with True
             if execution succeeds and with False if execution fails. One can send an email,
             a desktop notification or other things to inform user of the execution result.
+
+        max_workers : int
+            Maximum number of tasks running at the same time. Defaults to None meaning
+            every ready task is started at once, but 'process' backend still runs at most
+            as many tasks as cpus.
+
+        backend : str or gtui.backend.Backend
+            Where to run the tasks, 'thread' runs tasks in a thread pool and 'process' runs
+            tasks in worker processes, which suits CPU bound tasks. Defaults to 'thread'.
+            ShellTask is always run by a gtui.backend.ShellBackend and tasks of async
+            functions are always run by a gtui.backend.AsyncioBackend.
+
+        policy : str
+            One of gtui.scheduler.SchedulePolicy, the order to start ready tasks when
+            max_workers is reached. Defaults to 'fifo'.
+
+        durations : dict
+            Task name -> seconds, e.g. measured in previous runs with get_task_duration.
+            Used by 'critical_path' policy.
+
+        resources : dict
+            Resource name -> capacity, e.g. {'cpu': 32, 'db': 4}. A task only starts when
+            the resources in Task.resources can be acquired.
+
+        cache : bool, str or gtui.cache.ResultCache
+            Skip tasks whose function, arguments, input files and upstream tasks have not
+            changed since a cached successful run, replaying its stdout & log records.
+            True uses the default cache directory, a str specifies the directory.
+            Defaults to None meaning no cache.
+
+        journal : str or gtui.journal.Journal
+            Path of a journal file to append status transitions of tasks to.
+
+        resume : str
+            Path of a journal file of a previous run. Tasks succeeded in that run are
+            marked as Success without running, unless a task they wait for runs again.
+
+        max_output_memory : int
+            Maximum number of characters of stdout kept in memory for each task, older
+            output is spilled to a temporary file. None means no limit.
+
+        max_log_records : int
+            Maximum number of log records kept for each task, the oldest ones are dropped
+            when exceeded. None means no limit.
+
+        log_level : int or str
+            Log records of a task below this level are not collected, unless Task.log_level
+            is set. Defaults to logging.DEBUG.
+
+        log_rate_limit : float
+            Maximum log records per second collected for a task below WARNING, unless
+            Task.log_rate_limit is set. Defaults to None meaning no limit.
+
+        stdout_batch_size : int
+            Number of characters a task prints before they are written to its output
+            buffer in one batch, which speeds up tasks printing many short lines but delays
+            their output. Defaults to None meaning every write goes to the buffer.
+
+        capture_fd : bool
+            Whether capture file descriptors 1 & 2 of 'process' backend workers, so output of
+            C extensions, os.system and child processes goes to the task too. ShellTask output
+            is always captured this way. Defaults to False.
         """
         self.graph = graph
         self.callback = callback
-        self.log_collector = SeparateThreadLogCollector()
-        self.task2thread = {
-            task:IORedirectedThread(
-                target=task.run,
-                name=task.name,
-                callback=self.check_finish_status_and_schedule_task_to_run,
-                daemon=True
-            ) for task in graph.tasks
-        }
-        self.thread2started = {thread: False for thread in self.task2thread.values()}
+        self.log_collector = SeparateThreadLogCollector(max_records=max_log_records)
+        self.init_log_filters(log_level, log_rate_limit)
+
+        succeeded = ()
+        if resume is not None:
+            names = load_succeeded_task_names(resume)
+            # A FusedTask succeeded if all the tasks it runs did, as journals record their names
+            succeeded = [
+                t for t in graph.tasks
+                if t.name in names or (isinstance(t, FusedTask) and all(
+                    o.name in names for o in t.original_tasks))
+            ]
+        self.backend = get_backend(backend, max_workers=max_workers, capture_fd=capture_fd)
+        self.shell_backend = ShellBackend()
+        self.async_backend = AsyncioBackend()
+        self.backends = [self.backend, self.shell_backend, self.async_backend]
+
+        # Tasks are only marked as running when their backend can run them right away,
+        # e.g. 'process' backend runs as many tasks as cpus without max_workers
+        self.scheduler = Scheduler(
+            graph,
+            policy=policy,
+            max_running=max_workers,
+            durations=durations,
+            resources=resources,
+            succeeded=succeeded,
+            get_group=self.get_task_backend,
+            group_limits={b: b.max_workers for b in self.backends if b.max_workers is not None}
+        )
+        self.journal = get_journal(journal)
+        if self.journal is not None:
+            self.scheduler.add_listener(self.journal.record)
+        self.task2stdout = {task: OutputBuffer(max_memory=max_output_memory) for task in graph.tasks}
+        self.stdout_batch_size = stdout_batch_size
+        self.task2error = {}
+        self.task2traceback = {}
+        self.cache = get_cache(cache)
+        self.task2fingerprint = {}
+        self.cached_tasks = set()
+        self.is_success_notified = False
+        self.finished = threading.Event()
         self.thread_start_lock = threading.RLock()
 
+    def init_log_filters(self, log_level, log_rate_limit):
+        """Set a record filter for each task, records below the lowest level are not even created"""
+        self.task2log_level = {}
+        for task in self.graph.tasks:
+            level = get_level_number(log_level if task.log_level is None else task.log_level)
+            rate_limit = log_rate_limit if task.log_rate_limit is None else task.log_rate_limit
+            self.task2log_level[task] = level
+            if level > logging.DEBUG or rate_limit is not None:
+                self.log_collector.set_filter(task.name, RecordFilter(level, rate_limit))
+        self.log_collector.level = min(self.task2log_level.values(), default=logging.DEBUG)
+
     def start_execution(self):
         self.log_collector.init_log_setting()
+        for backend in self.backends:
+            backend.start(self)
+        self.start_ready_tasks()
+
+    def start_ready_tasks(self):
         with self.thread_start_lock:
-            for task in self.get_tasks_ready_to_run():
-                thread = self.task2thread[task]
-                thread.start()
-                self.thread2started[thread] = True
+            tasks = self.scheduler.pop_ready_tasks()
+            while tasks:
+                for task in tasks:
+                    if self.restore_from_cache(task):
+                        self.scheduler.finish(task, success=True)
+                    else:
+                        self.get_task_backend(task).submit(task)
+                # Tasks restored from cache may release more tasks
+                tasks = self.scheduler.pop_ready_tasks()
+
+            notify_success = self.scheduler.is_all_success() and not self.is_success_notified
+            self.is_success_notified = self.is_success_notified or notify_success
+            if self.scheduler.num_running == 0:
+                for backend in self.backends:
+                    backend.shutdown()
+                if self.journal is not None:
+                    self.journal.close()
+                self.finished.set()
+
+        if notify_success and self.callback:
+            self.callback(True)
 
-    def check_finish_status_and_schedule_task_to_run(self):
-        if self.if_any_failed_task() and self.callback:
-            self.callback(False)
+    def get_task_backend(self, task: Task):
+        if isinstance(task, ShellTask):
+            return self.shell_backend
+        if task.is_async:
+            return self.async_backend
+        return self.backend
+
+    def wait(self, timeout=None):
+        """Block until no task is running or can be started, returns False on timeout"""
+        return self.finished.wait(timeout)
+
+    def close_outputs(self):
+        """Remove files output of tasks spilled to, call it when the output is no longer read"""
+        for buffer in self.task2stdout.values():
+            buffer.close()
+
+    def get_task_stdout(self, task: Task):
+        """Returns the file-like object sys.stdout writes to while running task"""
+        if self.stdout_batch_size:
+            return BatchedWriter(self.task2stdout[task], self.stdout_batch_size)
+        return self.task2stdout[task]
+
+    def run_task(self, task: Task):
+        """Run a task in current thread with stdout & log redirected, then schedule next tasks"""
+        error, tb = None, None
+        stdout = self.get_task_stdout(task)
+        stdout_token = _current_stdout.set(stdout)
+        task_name_token = _current_task_name.set(task.name)
+        try:
+            task.run()
+        except BaseException as e:
+            error, tb = e, traceback.format_exc()
+            logging.debug('Task %s exit with error %s traceback: %s', task.name, e, tb)
+        finally:
+            stdout.flush()
+            _current_stdout.reset(stdout_token)
+            _current_task_name.reset(task_name_token)
+
+        self.finish_task(task, error, tb)
+
+    async def run_task_async(self, task: Task):
+        """Same as run_task but for tasks of async functions, called in event loop thread"""
+        error, tb = None, None
+        stdout = self.get_task_stdout(task)
+        stdout_token = _current_stdout.set(stdout)
+        task_name_token = _current_task_name.set(task.name)
+        try:
+            await task.run_async()
+        except BaseException as e:
+            error, tb = e, traceback.format_exc()
+            logging.debug('Task %s exit with error %s traceback: %s', task.name, e, tb)
+        finally:
+            stdout.flush()
+            _current_stdout.reset(stdout_token)
+            _current_task_name.reset(task_name_token)
 
-        if self.if_all_tasks_success() and self.callback:
-            self.callback(True)
+        self.finish_task(task, error, tb)
+
+    def write_task_output(self, task: Task, text):
+        self.task2stdout[task].write(text)
+
+    def add_task_log_record(self, task: Task, record: logging.LogRecord):
+        self.log_collector.add_record(task.name, record)
+
+    def finish_task(self, task: Task, error=None, tb=None):
+        """Called by backend when a task is finished, error is None if it succeeded"""
+        if error is not None:
+            self.task2error[task] = error
+            self.task2traceback[task] = tb
+        self.check_finish_status_and_schedule_task_to_run(task)
+
+    def check_finish_status_and_schedule_task_to_run(self, task):
+        error = self.task2error.get(task)
+        if error is None:
+            self.save_to_cache(task)
 
         with self.thread_start_lock:
-            for task in self.get_tasks_ready_to_run():
-                thread = self.task2thread[task]
-                thread.start()
-                self.thread2started[thread] = True
-
-    def get_tasks_ready_to_run(self):
-        ready_tasks = [
-            task
-            for task, waiting_for in self.graph.task2waiting_for.items()
-            if self.get_task_status(task) == TaskStatus.Waiting and self.if_all_tasks_success(waiting_for)
-        ]
-        return ready_tasks
+            self.scheduler.finish(task, success=error is None)
+            first_failure = error is not None and self.scheduler.num_failure == 1
+
+        if first_failure and self.callback:
+            self.callback(False)
+
+        self.start_ready_tasks()
+
+    def restore_from_cache(self, task: Task):
+        """Returns True if the task is found in cache and its output & log records are restored"""
+        if self.cache is None or not task.cacheable:
+            return False
+
+        upstream = [self.task2fingerprint.get(t) for t in set(self.graph.task2waiting_for[task])]
+        if None in upstream:
+            return False
+        fingerprint = task_fingerprint(task, upstream)
+        if fingerprint is None:
+            return False
+        self.task2fingerprint[task] = fingerprint
+
+        result = self.cache.get(fingerprint)
+        if result is None:
+            return False
+
+        stdout, records = result
+        self.write_task_output(task, stdout)
+        for record in records:
+            self.add_task_log_record(task, record)
+        self.cached_tasks.add(task)
+        return True
+
+    def save_to_cache(self, task: Task):
+        fingerprint = self.task2fingerprint.get(task)
+        if fingerprint is None or task in self.cached_tasks:
+            return
+        try:
+            self.cache.put(fingerprint, self.get_task_output(task), self.get_task_log_records(task))
+        except Exception as e:
+            logging.warning('Failed to cache result of task %s: %s', task.name, e)
+
+    def set_task_listener(self, task: Task, listener):
+        """Call listener without arguments whenever task writes output or log, None to stop"""
+        self.task2stdout[task].listener = listener
+        self.log_collector.get_store(task.name).listener = listener
 
     def get_task_output(self, task: Task):
-        return self.task2thread[task].get_stdout_content()
+        return self.task2stdout[task].getvalue()
 
-    def get_task_thread(self, task: Task):
-        return self.task2thread[task]
+    def read_task_output_since(self, task: Task, offset):
+        """Returns output of task after character offset and the new offset"""
+        return self.task2stdout[task].read_since(offset)
+
+    def get_task_error(self, task: Task):
+        """Returns the exception raised by a task or None"""
+        return self.task2error.get(task)
 
     def get_task_status(self, task: Task):
-        thread = self.get_task_thread(task)
-        if thread.is_alive():
-            return TaskStatus.Running
-        if not self.thread2started[thread]:
-            return TaskStatus.Waiting
-        if thread.error:
-            return TaskStatus.Failure
-        return TaskStatus.Success
+        return self.scheduler.get_status(task)
+
+    def is_task_cached(self, task: Task):
+        """Whether the task is skipped because its result is found in cache"""
+        return task in self.cached_tasks
+
+    def is_task_resumed(self, task: Task):
+        """Whether the task is skipped because it succeeded in the resumed run"""
+        return task in self.scheduler.skipped_tasks
+
+    def get_task_duration(self, task: Task):
+        """Returns seconds the task has been running or ran, None if it has not started"""
+        return self.scheduler.get_duration(task)
 
     def get_task_log_records(self, task: Task):
-        thread = self.task2thread[task]
-        records = self.log_collector.get_thread_log_records(thread.name)
+        records = self.log_collector.get_thread_log_records(task.name)
         return records
 
+    def read_task_log_records_since(self, task: Task, start):
+        """Returns log records of task from index start and the index after them"""
+        return self.log_collector.read_thread_log_records_since(task.name, start)
+
+    def get_task_log_level(self, task: Task):
+        """Returns the level below which log records of task are not collected"""
+        return self.task2log_level[task]
+
+    def get_task_num_suppressed_log_records(self, task: Task):
+        """Returns number of log records of task rejected by its level or rate limit"""
+        return self.log_collector.get_num_suppressed_records(task.name)
+
+    def get_task_num_dropped_log_records(self, task: Task):
+        """Returns number of the oldest log records of task dropped to stay within max_log_records"""
+        return self.log_collector.get_num_dropped_records(task.name)
+
     def get_main_thread_log_records(self):
         return self.log_collector.get_main_thread_log_records()
 
     def if_all_tasks_success(self, tasks=None):
         if tasks is None:
-            tasks = self.graph.tasks
+            return self.scheduler.is_all_success()
         return all([self.get_task_status(t) == TaskStatus.Success for t in tasks])
 
     def if_any_failed_task(self):
-        return any([self.get_task_status(t) == TaskStatus.Failure for t in self.graph.tasks])
+        return self.scheduler.has_failure()
@@ -0,0 +1,130 @@
+"""
+A runner to execute the task graph without the text user interface.
+
+It's meant for CI, cron jobs or anywhere without a terminal. It drives the
+executor directly and reports status transitions of tasks as text lines or
+JSON events to a stream, e.g. stderr or a file, then returns an exit code.
+"""
+import sys
+import json
+import time
+
+from .task import TaskGraph, TaskStatus
+from .executor import Executor
+
+
+class HeadlessRunner:
+    """Run a task graph and stream task status changes instead of showing a TUI"""
+
+    FORMAT_TEXT = 'text'
+    FORMAT_JSON = 'json'
+
+    def __init__(self, graph: TaskGraph, callback=None, stream=None, event_format=FORMAT_TEXT,
+                 show_output=False, **kwargs):
+        """Init a headless runner with the task graph and other options.
+
+        Parameters
+        ----------
+        callback : function
+            A function which accepts a boolean indicating whether execution succeeds.
+            It will be called when execution finishes.
+        stream : file or str
+            A file object or a path to write events to. Defaults to sys.stderr.
+        event_format : str
+            'text' writes a line per event, 'json' writes a JSON object per line.
+        show_output : bool
+            Whether write the stdout of each task when it finishes. Output of failed
+            tasks is always written in text format.
+        kwargs :
+            Options of gtui.executor.Executor, e.g. max_workers.
+        """
+        if event_format not in (self.FORMAT_TEXT, self.FORMAT_JSON):
+            raise ValueError('event_format should be "text" or "json", got {!r}'.format(event_format))
+
+        self.graph = graph
+        self.callback = callback
+        self.event_format = event_format
+        self.show_output = show_output
+        self.should_close_stream = isinstance(stream, str)
+        if stream is None:
+            stream = sys.stderr
+        elif isinstance(stream, str):
+            stream = open(stream, 'a')
+        self.stream = stream
+
+        self.executor = Executor(graph, callback=callback, **kwargs)
+        self.executor.scheduler.add_listener(self.on_status_change)
+
+    def on_status_change(self, task, status):
+        error = self.executor.get_task_error(task) if status == TaskStatus.Failure else None
+        output = None
+        if status == TaskStatus.Failure or (self.show_output and status == TaskStatus.Success):
+            output = self.executor.get_task_output(task)
+
+        if self.event_format == self.FORMAT_JSON:
+            event = {'time': time.time(), 'task': task.name, 'status': status}
+            if error is not None:
+                event['error'] = repr(error)
+            if output is not None and self.show_output:
+                event['output'] = output
+            self.write(json.dumps(event))
+            return
+
+        line = '[{}] {:<7} {}'.format(time.strftime('%Y-%m-%d %H:%M:%S'), status, task.name)
+        if error is not None:
+            line += ': {!r}'.format(error)
+        self.write(line)
+        if output:
+            self.write(''.join('    | ' + l for l in output.splitlines(True)).rstrip('\n'))
+        if status == TaskStatus.Failure and self.executor.task2traceback.get(task):
+            self.write(self.executor.task2traceback[task].rstrip('\n'))
+
+    def write(self, line):
+        self.stream.write(line + '\n')
+        self.stream.flush()
+
+    def summary(self):
+        status2count = {s: 0 for s in (TaskStatus.Success, TaskStatus.Failure, TaskStatus.Waiting)}
+        for task in self.graph.tasks:
+            status = self.executor.get_task_status(task)
+            status2count[status] = status2count.get(status, 0) + 1
+
+        if self.event_format == self.FORMAT_JSON:
+            self.write(json.dumps({
+                'time': time.time(),
+                'summary': {
+                    'success': status2count[TaskStatus.Success],
+                    'failure': status2count[TaskStatus.Failure],
+                    'not_run': status2count[TaskStatus.Waiting],
+                }
+            }))
+        else:
+            self.write('{} succeeded, {} failed, {} not run'.format(
+                status2count[TaskStatus.Success],
+                status2count[TaskStatus.Failure],
+                status2count[TaskStatus.Waiting],
+            ))
+
+    def run(self):
+        """Execute the graph and block until finished.
+
+        Returns
+        -------
+        int
+            0 if all tasks succeed, 1 if any task fails, 130 if interrupted.
+        """
+        try:
+            self.executor.start_execution()
+            # Wait in short steps so that KeyboardInterrupt can be handled
+            while not self.executor.wait(0.5):
+                pass
+        except KeyboardInterrupt:
+            self.write('Interrupted')
+            return 130
+        finally:
+            self.summary()
+            self.executor.close_outputs()
+            if self.should_close_stream:
+                self.stream.close()
+
+        return 0 if self.executor.if_all_tasks_success() else 1
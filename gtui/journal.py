@@ -0,0 +1,82 @@
+"""
+A journal of task status transitions to resume a failed run.
+
+The journal is an append-only file with one JSON object per line, e.g.
+
+    {"time": 1571234567.89, "task": "t1", "status": "Running"}
+
+Lines are flushed as they are written but fsync is batched, at most once
+per fsync_interval seconds and when execution finishes. When resuming, tasks
+whose last recorded status is Success are not run again.
+"""
+import os
+import json
+import time
+import threading
+
+from .task import TaskStatus, FusedTask
+
+
+class Journal:
+    """Append task status transitions to a file"""
+
+    def __init__(self, path, fsync_interval=1.0):
+        """
+        Parameters
+        ----------
+        path : str
+            path of the journal file, created if not exists
+        fsync_interval : float
+            minimum seconds between two fsync calls
+        """
+        self.path = path
+        self.fsync_interval = fsync_interval
+        self.file = open(path, 'a')
+        self.last_sync_time = time.time()
+        self.lock = threading.RLock()
+
+    def record(self, task, status):
+        # Tasks fused by TaskGraph.optimize are recorded by their own names, so that the
+        # journal can resume a run of the graph whether it's optimized or not
+        tasks = task.original_tasks if isinstance(task, FusedTask) else [task]
+        now = time.time()
+        lines = ''.join(
+            json.dumps({'time': now, 'task': t.name, 'status': status}) + '\n' for t in tasks)
+        with self.lock:
+            self.file.write(lines)
+            self.file.flush()
+            if time.time() - self.last_sync_time >= self.fsync_interval:
+                self.sync()
+
+    def sync(self):
+        with self.lock:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.last_sync_time = time.time()
+
+    def close(self):
+        with self.lock:
+            if not self.file.closed:
+                self.file.flush()
+                os.fsync(self.file.fileno())
+                self.file.close()
+
+
+def load_succeeded_task_names(path):
+    """Returns names of tasks whose last status in the journal is Success"""
+    task2status = {}
+    with open(path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue  # Last line may be incomplete if the process was killed
+            task2status[entry['task']] = entry['status']
+    return {name for name, status in task2status.items() if status == TaskStatus.Success}
+
+
+def get_journal(journal):
+    """Returns a Journal given None, a path or a Journal"""
+    if journal is None or isinstance(journal, Journal):
+        return journal
+    return Journal(journal)
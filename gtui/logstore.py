@@ -0,0 +1,212 @@
+"""
+Compact storage of log records collected from tasks.
+
+Keeping every logging.LogRecord alive costs a lot on long runs: each one
+has about 20 attributes and may pin large objects through its args and
+exc_info. Instead, records are stored in columns. Timestamps, levels and
+line numbers go in arrays, and logger names, paths & function names are
+interned as ids into a table shared by all tasks. Messages are formatted
+eagerly so args are dropped, and tracebacks are kept as text.
+
+Each task keeps at most max_records records. When there are more, the
+oldest ones are dropped in batches and counted. LogRecords are rebuilt
+from the columns when they are read.
+
+Before being stored, records can be rejected by a RecordFilter of the
+task, by level or by rate, which is counted as well.
+"""
+import os
+import logging
+import threading
+from array import array
+
+from .utils import default_log_formatter
+
+# Maximum number of log records kept for each task by default
+DEFAULT_MAX_RECORDS = 100000
+
+
+def get_level_number(level):
+    """Returns the number of a level given its number or name, e.g. 'INFO'"""
+    if isinstance(level, str):
+        number = logging.getLevelName(level.upper())
+        if not isinstance(number, int):
+            raise ValueError('Unknown log level {!r}'.format(level))
+        return number
+    return int(level)
+
+
+class RecordFilter:
+    """Reject log records of a task below a level or beyond a rate, counting them"""
+
+    def __init__(self, level=logging.DEBUG, rate_limit=None):
+        """
+        Parameters
+        ----------
+        level : int or str
+            records below this level are rejected
+        rate_limit : float
+            maximum records per second accepted below WARNING, with bursts of up to
+            as many records. None means no limit.
+        """
+        self.level = get_level_number(level)
+        self.rate_limit = rate_limit
+        self.burst = None if rate_limit is None else max(1.0, rate_limit)
+        self.tokens = self.burst
+        self.last_time = None
+        self.num_suppressed = 0
+
+    def accept(self, record: logging.LogRecord):
+        if record.levelno < self.level:
+            self.num_suppressed += 1
+            return False
+        if self.rate_limit is None or record.levelno >= logging.WARNING:
+            return True
+
+        # Token bucket refilled at rate_limit tokens per second
+        if self.last_time is not None:
+            elapsed = max(0.0, record.created - self.last_time)
+            self.tokens = min(self.burst, self.tokens + elapsed * self.rate_limit)
+        self.last_time = record.created
+        if self.tokens < 1:
+            self.num_suppressed += 1
+            return False
+        self.tokens -= 1
+        return True
+
+
+class StringTable:
+    """Map strings to integer ids so that repeated strings are stored once"""
+
+    def __init__(self):
+        self.strings = []
+        self.string2id = {}
+        self.lock = threading.Lock()
+
+    def get_id(self, s):
+        string_id = self.string2id.get(s)
+        if string_id is None:
+            with self.lock:
+                string_id = self.string2id.get(s)
+                if string_id is None:
+                    string_id = len(self.strings)
+                    self.strings.append(s)
+                    self.string2id[s] = string_id
+        return string_id
+
+    def get_string(self, string_id):
+        return self.strings[string_id]
+
+
+class LogRecordStore:
+    """Log records of a task stored in columns, keeping at most max_records of the newest ones"""
+
+    def __init__(self, strings: StringTable, max_records=DEFAULT_MAX_RECORDS):
+        """
+        Parameters
+        ----------
+        strings : StringTable
+            table to intern logger names, paths, function & thread names
+        max_records : int
+            maximum number of records kept, None means no limit
+        """
+        self.strings = strings
+        self.max_records = max_records
+        self.lock = threading.Lock()
+
+        self.created = array('d')
+        self.levelnos = array('H')
+        self.linenos = array('l')
+        self.name_ids = array('l')
+        self.pathname_ids = array('l')
+        self.func_name_ids = array('l')
+        self.thread_name_ids = array('l')
+        self.messages = []
+        # Absolute index -> (exc_text, stack_info), only for the few records having them
+        self.index2extra = {}
+
+        # Number of records dropped, also the absolute index of the first record kept
+        self.num_dropped = 0
+        # A function called without arguments after each record is added
+        self.listener = None
+
+    def __len__(self):
+        return len(self.messages)
+
+    @property
+    def num_records(self):
+        """int : number of records ever added, including dropped ones"""
+        return self.num_dropped + len(self.messages)
+
+    def append(self, record: logging.LogRecord):
+        message = record.getMessage()
+        exc_text = record.exc_text
+        if record.exc_info and not exc_text:
+            exc_text = default_log_formatter.formatException(record.exc_info)
+        stack_info = getattr(record, 'stack_info', None)
+
+        strings = self.strings
+        with self.lock:
+            if exc_text or stack_info:
+                self.index2extra[self.num_records] = (exc_text, stack_info)
+            self.created.append(record.created)
+            self.levelnos.append(record.levelno)
+            self.linenos.append(record.lineno or 0)
+            self.name_ids.append(strings.get_id(record.name))
+            self.pathname_ids.append(strings.get_id(record.pathname))
+            self.func_name_ids.append(strings.get_id(record.funcName))
+            self.thread_name_ids.append(strings.get_id(record.threadName))
+            self.messages.append(message)
+
+            if self.max_records is not None and len(self.messages) > self.max_records:
+                self.drop(max(1, self.max_records // 4))
+
+        listener = self.listener
+        if listener is not None:
+            listener()
+
+    def drop(self, n):
+        """Drop the oldest n records, lock must be held"""
+        for column in (self.created, self.levelnos, self.linenos, self.name_ids,
+                       self.pathname_ids, self.func_name_ids, self.thread_name_ids,
+                       self.messages):
+            del column[:n]
+        self.num_dropped += n
+        if self.index2extra:
+            self.index2extra = {i: e for i, e in self.index2extra.items() if i >= self.num_dropped}
+
+    def make_record(self, i):
+        """Returns a LogRecord rebuilt from the i-th record kept, lock must be held"""
+        get_string = self.strings.get_string
+        pathname = get_string(self.pathname_ids[i])
+        created = self.created[i]
+        levelno = self.levelnos[i]
+        exc_text, stack_info = self.index2extra.get(self.num_dropped + i, (None, None))
+        return logging.makeLogRecord({
+            'name': get_string(self.name_ids[i]),
+            'msg': self.messages[i],
+            'args': None,
+            'levelno': levelno,
+            'levelname': logging.getLevelName(levelno),
+            'pathname': pathname,
+            'filename': os.path.basename(pathname),
+            'module': os.path.splitext(os.path.basename(pathname))[0],
+            'lineno': self.linenos[i],
+            'funcName': get_string(self.func_name_ids[i]),
+            'created': created,
+            'msecs': (created - int(created)) * 1000,
+            'relativeCreated': (created - logging._startTime) * 1000,
+            'threadName': get_string(self.thread_name_ids[i]),
+            'exc_text': exc_text,
+            'stack_info': stack_info,
+        })
+
+    def read_since(self, start=0):
+        """Returns records from absolute index start and the absolute index after them.
+
+        Records already dropped are skipped.
+        """
+        with self.lock:
+            first = max(0, start - self.num_dropped)
+            records = [self.make_record(i) for i in range(first, len(self.messages))]
+            return records, self.num_records
@@ -0,0 +1,357 @@
+"""
+Buffers collecting the stdout of tasks.
+
+A chatty task may print gigabytes of text, so the buffer only keeps a tail
+of its content in memory. When the memory part exceeds the limit, older
+content is spilled to a temporary file of the task and can still be read
+back on demand. The file is only open while it's written or read, so the
+number of open files doesn't grow with the number of tasks.
+"""
+import os
+import bisect
+import logging
+import weakref
+import itertools
+import tempfile
+import threading
+from array import array
+from collections import deque
+
+# Maximum number of characters kept in memory by default for each task
+DEFAULT_MAX_MEMORY = 1 << 20
+
+# Small writes are joined into one chunk every this many writes
+_JOIN_WRITES = 256
+
+# Spilled content is indexed every this many characters to seek by character offset
+_SPILL_INDEX_STEP = 1 << 12
+
+# Maximum number of characters read at once when building a line index
+_INDEX_READ_SIZE = 1 << 20
+
+logger = logging.getLogger(__name__)
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class OutputBuffer:
+    """A file-like text buffer keeping a hot tail in memory and spilling older content to disk"""
+
+    def __init__(self, max_memory=DEFAULT_MAX_MEMORY):
+        """
+        Parameters
+        ----------
+        max_memory : int
+            Maximum number of characters kept in memory. None means no limit.
+        """
+        self.max_memory = max_memory
+        self.lock = threading.Lock()
+        # A function called without arguments after each write, e.g. to wake up the UI
+        self.listener = None
+        self.chunks = deque()
+        self.recent_writes = []
+        self.memory_size = 0
+
+        # Characters spilled to file, with a sparse index of (char offset, byte offset)
+        # every _SPILL_INDEX_STEP characters to seek by character offset
+        self.spill_path = None
+        self.spill_finalizer = None
+        self.closed = False
+        # After a failed spill, e.g. too many open files, retry when memory reaches this size
+        self.next_spill_size = 0
+        self.spilled_size = 0
+        self.spilled_bytes = 0
+        self.spill_index = []
+
+    @property
+    def size(self):
+        """int : total number of characters written"""
+        return self.spilled_size + self.memory_size
+
+    def write(self, s):
+        if not s:
+            return 0
+        with self.lock:
+            self.recent_writes.append(s)
+            self.memory_size += len(s)
+            if len(self.recent_writes) >= _JOIN_WRITES:
+                self.join_recent_writes()
+            if (self.max_memory is not None and self.memory_size > self.max_memory
+                    and self.memory_size > self.next_spill_size):
+                self.spill()
+        listener = self.listener
+        if listener is not None:
+            listener()
+        return len(s)
+
+    def join_recent_writes(self):
+        """Join recent small writes into one chunk, lock must be held"""
+        if self.recent_writes:
+            self.chunks.append(''.join(self.recent_writes))
+            self.recent_writes = []
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+    def spill(self):
+        """Move older chunks to file so that at most half of max_memory stays in memory.
+
+        If the file can't be written, content stays in memory and spilling is
+        retried when another max_memory characters are written, so that the
+        task writing isn't failed by it.
+        """
+        self.join_recent_writes()
+        keep = self.max_memory // 2
+        num_chunks, size = 0, self.memory_size
+        for chunk in self.chunks:
+            if size <= keep:
+                break
+            num_chunks += 1
+            size -= len(chunk)
+        text = ''.join(itertools.islice(self.chunks, num_chunks))
+
+        if not self.closed:
+            try:
+                self.write_spill_file(text)
+            except OSError as e:
+                self.next_spill_size = self.memory_size + self.max_memory
+                logger.warning('Failed to spill output to file, keeping it in memory: %s', e)
+                return
+
+        for _ in range(num_chunks):
+            self.chunks.popleft()
+        self.memory_size = size
+        self.spilled_size += len(text)
+
+    def write_spill_file(self, text):
+        """Append text to the spill file & index it, lock must be held"""
+        if self.spill_path is None:
+            fd, path = tempfile.mkstemp(prefix='gtui-output-')
+            os.close(fd)
+            self.spill_path = path
+            # Remove the file when the buffer is garbage collected or at exit if not closed
+            self.spill_finalizer = weakref.finalize(self, _remove_file, path)
+
+        # Write from the end of indexed content, overwriting what a failed write left
+        index, num_bytes = [], self.spilled_bytes
+        with open(self.spill_path, 'r+b') as f:
+            f.seek(num_bytes)
+            for i in range(0, len(text), _SPILL_INDEX_STEP):
+                data = text[i:i + _SPILL_INDEX_STEP].encode('utf-8', errors='surrogatepass')
+                index.append((self.spilled_size + i, num_bytes))
+                f.write(data)
+                num_bytes += len(data)
+        self.spill_index.extend(index)
+        self.spilled_bytes = num_bytes
+
+    def read_spilled(self, start=0, end=None):
+        """Returns spilled content between character offsets start & end, lock must be held
+
+        Returns an empty str if the file can't be read, e.g. after close.
+        """
+        end = self.spilled_size if end is None else min(end, self.spilled_size)
+        if self.spill_path is None or start >= end:
+            return ''
+        i = bisect.bisect_right(self.spill_index, (start, float('inf'))) - 1
+        j = bisect.bisect_left(self.spill_index, (end, -1))
+        char_offset, byte_offset = self.spill_index[i]
+        end_byte = self.spill_index[j][1] if j < len(self.spill_index) else self.spilled_bytes
+        try:
+            with open(self.spill_path, 'rb') as f:
+                f.seek(byte_offset)
+                data = f.read(end_byte - byte_offset)
+        except OSError:
+            return ''
+        text = data.decode('utf-8', errors='surrogatepass')
+        return text[start - char_offset:end - char_offset]
+
+    def read_memory(self, start, end):
+        """Returns content in memory between character offsets start & end, lock must be held"""
+        offset = self.spilled_size
+        pieces = []
+        for piece in self.iter_memory():
+            if offset >= end:
+                break
+            if offset + len(piece) > start:
+                pieces.append(piece[max(0, start - offset):end - offset])
+            offset += len(piece)
+        return ''.join(pieces)
+
+    def read(self, start, end=None):
+        """Returns content between character offsets start & end, which may be spilled to disk"""
+        with self.lock:
+            end = self.size if end is None else min(end, self.size)
+            if start >= end:
+                return ''
+            text = ''
+            if start < self.spilled_size:
+                text = self.read_spilled(start, end)
+            if end > self.spilled_size:
+                text += self.read_memory(max(start, self.spilled_size), end)
+            return text
+
+    def read_since(self, offset):
+        """Returns the text written after character offset and the new offset
+
+        Reading the tail only touches the last chunks in memory, so it's cheap
+        to poll with the offset returned by the previous call.
+        """
+        with self.lock:
+            size = self.size
+            if offset >= size:
+                return '', size
+            if offset < self.spilled_size:
+                return self.read_spilled(offset) + ''.join(self.chunks) + ''.join(self.recent_writes), size
+
+            need = size - offset
+            pieces, length = [], 0
+            for piece in self.iter_memory_reversed():
+                pieces.append(piece)
+                length += len(piece)
+                if length >= need:
+                    break
+            text = ''.join(reversed(pieces))
+            return text[len(text) - need:], size
+
+    def iter_memory(self):
+        """Yields the chunks in memory from the oldest to the newest, lock must be held"""
+        yield from self.chunks
+        yield from self.recent_writes
+
+    def iter_memory_reversed(self):
+        """Yields the chunks in memory from the newest to the oldest, lock must be held"""
+        yield from reversed(self.recent_writes)
+        yield from reversed(self.chunks)
+
+    def getvalue(self):
+        """Returns the full content, including the part spilled to disk"""
+        with self.lock:
+            return self.read_spilled() + ''.join(self.chunks) + ''.join(self.recent_writes)
+
+    def close(self):
+        """Remove the spill file, content spilled after it is dropped"""
+        with self.lock:
+            self.closed = True
+            if self.spill_finalizer is not None:
+                self.spill_finalizer()
+            self.spill_path = None
+
+
+class LineIndex:
+    """An index of line start offsets of an OutputBuffer, built incrementally.
+
+    Only the offsets are kept, lines are read back from the buffer on demand,
+    so showing a window of lines costs the same however long the output is.
+    """
+
+    def __init__(self, buffer: OutputBuffer):
+        self.buffer = buffer
+        self.starts = array('q', [0])
+        self.indexed_size = 0
+
+    def update(self):
+        """Index output written since last update, returns whether there's new output"""
+        size = self.buffer.size
+        if self.indexed_size >= size:
+            return False
+        while self.indexed_size < size:
+            text = self.buffer.read(self.indexed_size, min(size, self.indexed_size + _INDEX_READ_SIZE))
+            if not text:
+                break
+            pos = text.find('\n')
+            while pos != -1:
+                self.starts.append(self.indexed_size + pos + 1)
+                pos = text.find('\n', pos + 1)
+            self.indexed_size += len(text)
+        return True
+
+    def __len__(self):
+        return len(self.starts)
+
+    def get_lines(self, start, stop):
+        """Returns lines in [start, stop) without line breaks"""
+        stop = min(stop, len(self.starts))
+        if start >= stop:
+            return []
+        end = self.starts[stop] - 1 if stop < len(self.starts) else self.indexed_size
+        return self.buffer.read(self.starts[start], end).split('\n')
+
+
+class BatchedWriter:
+    """Collect small writes of a task and pass them to a buffer in batches.
+
+    It saves the per-write locking of the buffer for tasks printing many short
+    lines, at the cost of output showing up batch_size characters later. Call
+    flush when the task finishes.
+    """
+
+    def __init__(self, buffer, batch_size):
+        self.buffer = buffer
+        self.batch_size = batch_size
+        self.pieces = []
+        self.size = 0
+
+    def write(self, s):
+        self.pieces.append(s)
+        self.size += len(s)
+        if self.size >= self.batch_size:
+            self.flush()
+        return len(s)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        if self.pieces:
+            text = ''.join(self.pieces)
+            self.pieces = []
+            self.size = 0
+            self.buffer.write(text)
+
+    def isatty(self):
+        return False
+
+
+class StdoutRouter:
+    """A replacement of sys.stdout writing to the stdout of the current task.
+
+    The target is looked up in a context variable on each write, falling back
+    to default outside of tasks. Other attributes are forwarded to the target.
+    """
+
+    def __init__(self, context_var, default):
+        """
+        Parameters
+        ----------
+        context_var : contextvars.ContextVar
+            variable holding the file-like object of current task
+        default : file
+            file to write to when the variable is not set, e.g. sys.__stdout__
+        """
+        self.context_var = context_var
+        self.default = default
+
+    def write(self, s):
+        return self.context_var.get(self.default).write(s)
+
+    def writelines(self, lines):
+        self.context_var.get(self.default).writelines(lines)
+
+    def flush(self):
+        self.context_var.get(self.default).flush()
+
+    def __getattr__(self, name):
+        return getattr(self.context_var.get(self.default), name)
@@ -0,0 +1,294 @@
+"""
+An incremental scheduler used by the executor.
+
+Instead of rescanning the whole graph whenever a task finishes, it keeps
+for each task the number of dependencies not yet succeeded and the list
+of tasks waiting for it. Finishing a task only touches its direct dependents,
+and the success/failure aggregates are plain counters.
+
+Ready tasks are kept in a heap ordered by a scheduling policy, so when the
+number of running tasks is limited the most important ones start first.
+A ready task only starts when the resources it declares can be acquired,
+smaller tasks behind it are started in the meantime if they fit.
+
+Listeners can be registered to be notified of every status transition.
+"""
+import time
+import heapq
+import threading
+
+from .task import TaskStatus, FusedTask
+
+# Allowed status transitions, anything else is a bug in the executor
+_TRANSITIONS = {
+    TaskStatus.Waiting: (TaskStatus.Running,),
+    TaskStatus.Running: (TaskStatus.Success, TaskStatus.Failure),
+    TaskStatus.Success: (),
+    TaskStatus.Failure: (),
+}
+
+
+class SchedulePolicy:
+    """Enum for the order in which ready tasks are started"""
+    Fifo = 'fifo'                   # in the order they become ready
+    Priority = 'priority'           # higher Task.priority first
+    CriticalPath = 'critical_path'  # longer remaining path to the end of graph first
+
+    ALL = (Fifo, Priority, CriticalPath)
+
+
+# Duration of a task without any estimation, critical path then counts tasks
+DEFAULT_DURATION = 1.0
+
+
+class Scheduler:
+    """Track status of tasks in a graph and decide which tasks are ready to run"""
+
+    def __init__(self, graph, policy=SchedulePolicy.Fifo, max_running=None, durations=None,
+                 resources=None, succeeded=(), get_group=None, group_limits=None):
+        """
+        Parameters
+        ----------
+        graph : TaskGraph
+            tasks and their dependencies
+        policy : str
+            one of SchedulePolicy, the order in which ready tasks are started
+        max_running : int
+            maximum number of running tasks, defaults to None meaning no limit
+        durations : dict
+            task name -> duration in seconds, e.g. measured in previous runs.
+            Used by critical_path policy, falls back to Task.estimated_duration.
+        resources : dict
+            resource name -> capacity, e.g. {'cpu': 32, 'db': 4}. Tasks declaring
+            resources in Task.resources only run when they can be acquired.
+            Resources without capacity are not limited.
+        succeeded : iterable
+            tasks succeeded in a previous run, they are marked as Success without
+            running unless a task they wait for has to run again.
+        get_group : function
+            task -> a hashable group, e.g. the backend running the task
+        group_limits : dict
+            group -> maximum number of running tasks of the group, on top of max_running.
+            Groups not in it are not limited.
+
+        Raises
+        ------
+        ValueError
+            If policy is unknown or a task needs more resource than the capacity.
+        """
+        if policy not in SchedulePolicy.ALL:
+            raise ValueError('Unknown schedule policy {!r}, should be one of {}'.format(
+                policy, ', '.join(SchedulePolicy.ALL)))
+        if max_running is not None and max_running < 1:
+            raise ValueError('max_running must be greater than 0, got {}'.format(max_running))
+
+        self.graph = graph
+        self.policy = policy
+        self.max_running = max_running
+        self.durations = durations or {}
+        self.capacity = dict(resources or {})
+        self.available = dict(self.capacity)
+        self.get_group = get_group
+        self.group_limits = dict(group_limits or {})
+        self.group2running = {group: 0 for group in self.group_limits}
+        self.lock = threading.RLock()
+        self.task2status = {}
+        self.task2remaining = {}
+        self.task2dependents = {t: graph.get_dependents(t) for t in graph.tasks}
+        self.task2start_time = {}
+        self.task2end_time = {}
+        self.listeners = []
+
+        for task in graph.tasks:
+            for name, amount in task.resources.items():
+                if amount > self.capacity.get(name, amount):
+                    raise ValueError('Task {} needs {} {} but the capacity is {}'.format(
+                        task.name, amount, name, self.capacity[name]))
+
+            self.task2status[task] = TaskStatus.Waiting
+            self.task2remaining[task] = len(graph.id2waiting_for[graph.get_task_id(task)])
+
+        if policy == SchedulePolicy.CriticalPath:
+            self.task2rank = self.critical_path_lengths()
+        elif policy == SchedulePolicy.Priority:
+            self.task2rank = {t: t.priority for t in graph.tasks}
+        else:
+            self.task2rank = None
+
+        # Ready tasks bucketed by the limited resources they need -> heap of them in policy order.
+        # Tasks of a bucket fit or not all together, so a blocked bucket is skipped at once.
+        self.needs2ready = {}
+        self.sequence = 0
+        self.num_running = 0
+        self.num_success = 0
+        self.num_failure = 0
+
+        self.skipped_tasks = set()
+        if succeeded:
+            self.skip_succeeded_tasks(set(succeeded))
+
+        for task in graph.tasks:
+            if self.task2status[task] == TaskStatus.Waiting and self.task2remaining[task] == 0:
+                self.push_ready(task)
+
+    def add_listener(self, listener):
+        """Register a function called with (task, status) on every status transition"""
+        self.listeners.append(listener)
+
+    def topological_order(self):
+        """Returns tasks ordered so that each task comes after the tasks it waits for"""
+        return self.graph.topological_order()
+
+    def skip_succeeded_tasks(self, succeeded):
+        """Mark tasks succeeded in a previous run as Success if all their upstream tasks are skipped"""
+        for task in self.topological_order():
+            if task not in succeeded:
+                continue
+            if any(self.task2status[w] != TaskStatus.Success for w in self.graph.task2waiting_for[task]):
+                continue
+
+            self.task2status[task] = TaskStatus.Success
+            self.num_success += 1
+            self.skipped_tasks.add(task)
+            for dependent in self.task2dependents[task]:
+                self.task2remaining[dependent] -= 1
+
+    def get_duration_estimation(self, task):
+        duration = self.durations.get(task.name)
+        if duration is None and isinstance(task, FusedTask):
+            return sum(self.get_duration_estimation(t) for t in task.tasks)
+        if duration is None:
+            duration = task.estimated_duration
+        return DEFAULT_DURATION if duration is None else duration
+
+    def critical_path_lengths(self):
+        """Returns task -> estimated duration of the longest path from task to the end of graph"""
+        task2length = {}
+        for task in reversed(self.topological_order()):
+            downstream = [task2length[d] for d in self.task2dependents[task]]
+            task2length[task] = self.get_duration_estimation(task) + max(downstream, default=0)
+        return task2length
+
+    def get_needs(self, task):
+        """Returns (limited group of the task or None, limited resources it needs as (name, amount) pairs)"""
+        group = self.get_group(task) if self.get_group is not None else None
+        return group if group in self.group_limits else None, tuple(sorted(
+            (name, amount) for name, amount in task.resources.items()
+            if name in self.capacity and amount > 0
+        ))
+
+    def push_ready(self, task):
+        rank = self.task2rank[task] if self.task2rank is not None else 0
+        needs = self.get_needs(task)
+        heapq.heappush(self.needs2ready.setdefault(needs, []), (-rank, self.sequence, task))
+        self.sequence += 1
+
+    def get_status(self, task):
+        return self.task2status[task]
+
+    def get_duration(self, task):
+        """Returns seconds the task has been running or ran, None if it has not started"""
+        start = self.task2start_time.get(task)
+        if start is None:
+            return None
+        return self.task2end_time.get(task, time.time()) - start
+
+    def set_status(self, task, status):
+        """Move a task to a new status
+
+        Raises
+        ------
+        ValueError
+            If the transition is not allowed, e.g. Success -> Running.
+        """
+        with self.lock:
+            current = self.task2status[task]
+            if status not in _TRANSITIONS[current]:
+                raise ValueError('Invalid status transition of task {}: {} -> {}'.format(
+                    task.name, current, status))
+            self.task2status[task] = status
+
+            if current == TaskStatus.Running:
+                self.num_running -= 1
+                self.task2end_time[task] = time.time()
+            if status == TaskStatus.Running:
+                self.num_running += 1
+                self.task2start_time[task] = time.time()
+            elif status == TaskStatus.Success:
+                self.num_success += 1
+            elif status == TaskStatus.Failure:
+                self.num_failure += 1
+
+            for listener in self.listeners:
+                listener(task, status)
+
+    def can_acquire(self, task):
+        return self.can_fit(self.get_needs(task))
+
+    def can_fit(self, needs):
+        """Whether the group & resources given as returned by get_needs are available"""
+        group, resources = needs
+        if group is not None and self.group2running[group] >= self.group_limits[group]:
+            return False
+        return all(amount <= self.available[name] for name, amount in resources)
+
+    def acquire(self, task):
+        group, resources = self.get_needs(task)
+        if group is not None:
+            self.group2running[group] += 1
+        for name, amount in resources:
+            self.available[name] -= amount
+
+    def release(self, task):
+        group, resources = self.get_needs(task)
+        if group is not None:
+            self.group2running[group] -= 1
+        for name, amount in resources:
+            self.available[name] += amount
+
+    def pop_ready_tasks(self):
+        """Returns the tasks to start now in policy order and mark them as running
+
+        Tasks whose resources can't be acquired, or whose group is at its
+        limit, stay in the queue and the tasks after them which fit are started
+        instead. Only the first task of each bucket of ready tasks needing the
+        same group & resources is looked at,
+        so a blocked bucket costs the same however many tasks it holds.
+        """
+        with self.lock:
+            tasks = []
+            while self.max_running is None or self.num_running < self.max_running:
+                best = None
+                for needs, ready in self.needs2ready.items():
+                    if (best is None or ready[0] < best[1][0]) and self.can_fit(needs):
+                        best = needs, ready
+                if best is None:
+                    break
+
+                needs, ready = best
+                task = heapq.heappop(ready)[2]
+                if not ready:
+                    del self.needs2ready[needs]
+                self.acquire(task)
+                self.set_status(task, TaskStatus.Running)
+                tasks.append(task)
+            return tasks
+
+    def finish(self, task, success):
+        """Mark a running task as finished and release its dependents if it succeeded"""
+        with self.lock:
+            self.set_status(task, TaskStatus.Success if success else TaskStatus.Failure)
+            self.release(task)
+            if not success:
+                return
+
+            for dependent in self.task2dependents[task]:
+                self.task2remaining[dependent] -= 1
+                if self.task2remaining[dependent] == 0:
+                    self.push_ready(dependent)
+
+    def is_all_success(self):
+        return self.num_success == len(self.task2status)
+
+    def has_failure(self):
+        return self.num_failure > 0
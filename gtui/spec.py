@@ -0,0 +1,167 @@
+"""
+Load a task graph from a declarative spec file.
+
+A spec is a JSON, YAML or TOML document, chosen by file extension, e.g.
+
+    {
+      "title": "Nightly",
+      "options": {"max_workers": 4, "policy": "critical_path"},
+      "tasks": {
+        "fetch": "curl -o data.csv https://example.com/data.csv",
+        "clean": {"func": "pipeline.steps:clean", "args": ["data.csv"], "waiting_for": ["fetch"]},
+        "report": {"command": ["python", "report.py"], "waiting_for": ["clean"], "priority": 1}
+      }
+    }
+
+Each task is either a shell command, given as a str or under "command",
+or a function given by its import path under "func", as "module:attr" or
+"module.attr". "waiting_for" lists names of the tasks to wait for, other
+keys are options of Task. "options" are passed to TaskGraph.run.
+
+YAML needs PyYAML and TOML needs tomli before Python 3.11.
+"""
+import os
+import json
+import inspect
+import importlib
+
+from .task import Task, ShellTask, TaskGraph
+
+# Keys of a task spec passed to Task as they are
+_TASK_OPTIONS = ('priority', 'estimated_duration', 'resources', 'inputs', 'cacheable',
+                 'log_level', 'log_rate_limit')
+
+# Keys of a task spec passed to ShellTask only
+_SHELL_TASK_OPTIONS = ('env', 'cwd')
+
+
+def import_object(path):
+    """Returns the object given its import path, e.g. 'os.path:join' or 'os.path.join'"""
+    if ':' in path:
+        module_name, _, attrs = path.partition(':')
+        obj = importlib.import_module(module_name)
+    else:
+        # Import the longest importable prefix of the path
+        parts = path.split('.')
+        for i in range(len(parts) - 1, 0, -1):
+            try:
+                obj = importlib.import_module('.'.join(parts[:i]))
+            except ImportError:
+                continue
+            attrs = '.'.join(parts[i:])
+            break
+        else:
+            raise ImportError('Can not import {!r}'.format(path))
+
+    for attr in attrs.split('.'):
+        try:
+            obj = getattr(obj, attr)
+        except AttributeError:
+            raise ImportError('Can not import {!r}: no attribute {!r}'.format(path, attr))
+    return obj
+
+
+def make_task(name, spec):
+    """Returns a Task or ShellTask described by a task spec"""
+    if isinstance(spec, (str, list)):
+        spec = {'command': spec}
+    if not isinstance(spec, dict):
+        raise ValueError('Spec of task {!r} should be a command or a table, got {!r}'.format(name, spec))
+
+    known = set(_TASK_OPTIONS) | {'waiting_for'}
+    kwargs = {k: spec[k] for k in _TASK_OPTIONS if k in spec}
+    if 'command' in spec:
+        known |= {'command'} | set(_SHELL_TASK_OPTIONS)
+        kwargs.update({k: spec[k] for k in _SHELL_TASK_OPTIONS if k in spec})
+        task = ShellTask(name, spec['command'], **kwargs)
+    elif 'func' in spec:
+        known |= {'func', 'args', 'kwargs'}
+        if not isinstance(spec.get('args', []), list) or not isinstance(spec.get('kwargs', {}), dict):
+            raise ValueError('"args" of task {!r} should be a list and "kwargs" a table'.format(name))
+        func = import_object(spec['func'])
+        task = Task(name, func, args=tuple(spec.get('args', ())), kwargs=spec.get('kwargs'), **kwargs)
+    else:
+        raise ValueError('Task {!r} should have either "command" or "func"'.format(name))
+
+    unknown = set(spec) - known
+    if unknown:
+        raise ValueError('Unknown keys of task {!r}: {}'.format(name, ', '.join(sorted(unknown))))
+    return task
+
+
+def graph_from_spec(spec):
+    """Returns (graph, options) described by a spec, a dict loaded from a spec file
+
+    options are keyword arguments of TaskGraph.run, including title if set in the spec.
+
+    Raises
+    ------
+    ValueError
+        if the spec is malformed, refers to unknown tasks or contains a cycle
+    """
+    if not isinstance(spec, dict):
+        raise ValueError('Spec should be a table with a "tasks" table, got {!r}'.format(type(spec).__name__))
+    task_specs = spec.get('tasks')
+    if not isinstance(task_specs, dict) or not task_specs:
+        raise ValueError('Spec should have a non-empty "tasks" table')
+
+    tasks, edges = [], []
+    for name, task_spec in task_specs.items():
+        tasks.append(make_task(name, task_spec))
+        waiting_for = task_spec.get('waiting_for', []) if isinstance(task_spec, dict) else []
+        if isinstance(waiting_for, str):
+            waiting_for = [waiting_for]
+        if not isinstance(waiting_for, list) or not all(isinstance(w, str) for w in waiting_for):
+            raise ValueError('"waiting_for" of task {!r} should be a list of task names'.format(name))
+        edges.extend((name, w) for w in waiting_for)
+
+    graph = TaskGraph.from_edges(tasks, edges)
+    graph.raise_for_cycle()
+
+    options = spec.get('options', {})
+    if not isinstance(options, dict):
+        raise ValueError('"options" should be a table, got {!r}'.format(type(options).__name__))
+    unknown = set(options) - set(inspect.signature(TaskGraph.run).parameters) - {'self'}
+    if unknown:
+        raise ValueError('Unknown keys of "options": {}'.format(', '.join(sorted(unknown))))
+    options = dict(options)
+    if 'title' in spec:
+        options['title'] = spec['title']
+    return graph, options
+
+
+def read_spec(path):
+    """Returns the content of a JSON, YAML or TOML spec file as a dict"""
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.json':
+        with open(path) as f:
+            return json.load(f)
+
+    if ext in ('.yaml', '.yml'):
+        try:
+            import yaml
+        except ImportError:
+            raise ImportError('PyYAML is needed to load {}, try: pip install pyyaml'.format(path))
+        with open(path) as f:
+            try:
+                return yaml.safe_load(f)
+            except yaml.YAMLError as e:
+                raise ValueError('Invalid YAML in {}: {}'.format(path, e))
+
+    if ext == '.toml':
+        try:
+            import tomllib
+        except ImportError:
+            try:
+                import tomli as tomllib
+            except ImportError:
+                raise ImportError('tomli is needed to load {}, try: pip install tomli'.format(path))
+        with open(path, 'rb') as f:
+            return tomllib.load(f)
+
+    raise ValueError('Unknown spec format {!r}, expected .json, .yaml, .yml or .toml'.format(ext))
+
+
+def load_spec(path):
+    """Returns (graph, options) described by a JSON, YAML or TOML spec file, see graph_from_spec"""
+    return graph_from_spec(read_spec(path))
@@ -1,4 +1,12 @@
 """Task related definitions"""
+import os
+import sys
+import inspect
+import subprocess
+from collections.abc import Mapping
+
+from .output import DEFAULT_MAX_MEMORY
+from .logstore import DEFAULT_MAX_RECORDS
 
 class TaskStatus:
     """Enum for task status"""
@@ -9,16 +17,69 @@ class TaskStatus:
 
 
 class Task:
-    """A task consists of function, its parameters and a name associated with it"""
+    """A task consists of function, its parameters and a name associated with it.
+
+    The function can be an async function, such tasks are run as coroutines
+    sharing one event loop thread.
+    """
 
-    def __init__(self, name, func, args=(), kwargs=None):
+    def __init__(self, name, func, args=(), kwargs=None, priority=0, estimated_duration=None,
+                 resources=None, inputs=None, cacheable=True, log_level=None, log_rate_limit=None):
+        """
+        Parameters
+        ----------
+        name : str
+            unique name of the task
+        func : function
+            function to call, can be an async function
+        args : list or tuple
+            positional arguments of func
+        kwargs : dict
+            keyword arguments of func
+        priority : int
+            tasks with higher priority start first, used by 'priority' schedule policy
+        estimated_duration : float
+            estimated seconds to run, used by 'critical_path' schedule policy
+        resources : dict
+            resource name -> amount held while running, e.g. {'cpu': 8, 'db': 1}
+        inputs : list
+            paths of files the task reads, a change of them invalidates the cached result
+        cacheable : bool
+            whether the result can be cached when the graph is run with cache enabled
+        log_level : int or str
+            log records below this level are not collected, defaults to the level of the graph run
+        log_rate_limit : float
+            maximum log records per second collected below WARNING, defaults to the limit of the graph run
+        """
         self.name = name
         self.func = func
         self.args = args
         self.kwargs = kwargs or {}
+        self.priority = priority
+        self.estimated_duration = estimated_duration
+        self.resources = resources or {}
+        self.inputs = inputs or []
+        self.cacheable = cacheable
+        self.log_level = log_level
+        self.log_rate_limit = log_rate_limit
+
+    @property
+    def is_async(self):
+        """bool : whether func is an async function"""
+        return inspect.iscoroutinefunction(self.func)
 
     def run(self):
-        self.func(*self.args, **self.kwargs)
+        if self.is_async:
+            import asyncio  # Imported lazily, it's slow to import
+            asyncio.run(self.run_async())
+        else:
+            self.func(*self.args, **self.kwargs)
+
+    async def run_async(self):
+        if self.is_async:
+            await self.func(*self.args, **self.kwargs)
+        else:
+            self.func(*self.args, **self.kwargs)
 
     def __hash__(self):
         return hash(self.name)
@@ -34,12 +95,209 @@ class Task:
             self.kwargs
         )
 
+
+def popen_command(argv, env=None, cwd=None, **kwargs):
+    """Start a command in a child process, argv is run by the shell if it's a str"""
+    return subprocess.Popen(
+        argv,
+        stdin=subprocess.DEVNULL,
+        env=None if env is None else dict(os.environ, **env),
+        cwd=cwd,
+        shell=isinstance(argv, str),
+        **kwargs
+    )
+
+
+def run_command(argv, env=None, cwd=None):
+    """Run a command, copy its stdout & stderr to sys.stdout and raise if it exits with non-zero code"""
+    process = popen_command(
+        argv,
+        env=env,
+        cwd=cwd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        universal_newlines=True
+    )
+    with process.stdout:
+        for line in process.stdout:
+            sys.stdout.write(line)
+    returncode = process.wait()
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, argv)
+
+
+class ShellTask(Task):
+    """A task running a command in a child process.
+
+    When run by the executor, the child processes of all shell tasks are
+    watched by a single event loop thread which copies their stdout & stderr
+    into task output, and exit code other than 0 means failure.
+    """
+
+    def __init__(self, name, argv, env=None, cwd=None, **kwargs):
+        """
+        Parameters
+        ----------
+        name : str
+            name of the task
+        argv : list or str
+            a list of program & arguments, or a str which will be run by the shell
+        env : dict
+            extra environment variables, added to the ones of current process
+        cwd : str
+            working directory of the child process
+        kwargs :
+            other options of Task, e.g. priority
+        """
+        super().__init__(name, func=run_command, args=(argv,), kwargs={'env': env, 'cwd': cwd}, **kwargs)
+        self.argv = argv
+        self.env = env
+        self.cwd = cwd
+
+    def popen(self, **kwargs):
+        """Start the command of this task, kwargs are passed to subprocess.Popen"""
+        return popen_command(self.argv, env=self.env, cwd=self.cwd, **kwargs)
+
+    def __repr__(self):
+        return 'gtui.ShellTask(name={}, argv={!r}, env={!r}, cwd={!r})'.format(
+            self.name,
+            self.argv,
+            self.env,
+            self.cwd
+        )
+
+
+def run_tasks(tasks):
+    """Run tasks one after another, used by FusedTask"""
+    for task in tasks:
+        task.run()
+
+
+class FusedTask(Task):
+    """A linear chain of tasks run one after another as a single task, see TaskGraph.optimize"""
+
+    def __init__(self, tasks):
+        """
+        Parameters
+        ----------
+        tasks : list
+            tasks in running order, each one waits for the previous one
+        """
+        durations = [t.estimated_duration for t in tasks]
+        resources = {}
+        for t in tasks:
+            for name, amount in t.resources.items():
+                resources[name] = max(amount, resources.get(name, amount))
+
+        super().__init__(
+            name='{}..{}'.format(tasks[0].name, tasks[-1].name),
+            func=run_tasks,
+            args=(tasks,),
+            priority=max(t.priority for t in tasks),
+            estimated_duration=None if None in durations else sum(durations),
+            resources=resources,
+            inputs=[path for t in tasks for path in t.inputs],
+            cacheable=all(t.cacheable for t in tasks),
+            log_level=tasks[0].log_level,
+            log_rate_limit=tasks[0].log_rate_limit
+        )
+        self.tasks = tasks
+
+    @property
+    def original_tasks(self):
+        """list : the tasks fused, with the ones of nested FusedTask flattened"""
+        tasks = []
+        for task in self.tasks:
+            if isinstance(task, FusedTask):
+                tasks.extend(task.original_tasks)
+            else:
+                tasks.append(task)
+        return tasks
+
+    def __repr__(self):
+        return 'gtui.FusedTask(name={}, tasks={!r})'.format(self.name, self.tasks)
+
+
+class _WaitingForView(Mapping):
+    """A read-only mapping of task -> list of tasks it waits for, backed by a TaskGraph index"""
+
+    def __init__(self, graph):
+        self.graph = graph
+
+    def __getitem__(self, task):
+        return self.graph.get_waiting_for(task)
+
+    def __iter__(self):
+        return iter(self.graph.id2task)
+
+    def __len__(self):
+        return len(self.graph.id2task)
+
+    def __contains__(self, task):
+        return self.graph.has_task(task)
+
+
 class TaskGraph:
-    """A graph containing tasks and their execution dependencies"""
+    """A graph containing tasks and their execution dependencies
+
+    Tasks are given integer ids in insertion order. Edges are kept as ids in
+    insertion-ordered sets in both directions, so membership tests, adding
+    tasks & edges and looking up dependents are O(1) and duplicated edges
+    are ignored.
+    """
 
     def __init__(self):
-        self.tasks = []
-        self.task2waiting_for = {}
+        # Task name -> task id, in insertion order
+        self.name2id = {}
+        # Task id -> task
+        self.id2task = []
+        # Task id -> ids of tasks it waits for / ids of tasks waiting for it.
+        # Dicts with None values are used as insertion-ordered sets.
+        self.id2waiting_for = []
+        self.id2dependents = []
+
+    @property
+    def tasks(self):
+        """list : tasks in insertion order, should not be modified"""
+        return self.id2task
+
+    @property
+    def task2waiting_for(self):
+        """Mapping : task -> list of tasks it waits for, read-only"""
+        return _WaitingForView(self)
+
+    def get_task_id(self, task):
+        """Returns the id of a task in this graph, raises KeyError if it's not in the graph"""
+        return self.name2id[task.name]
+
+    def get_task(self, name):
+        """Returns the task with given name, or the FusedTask running the task with given name.
+
+        Raises KeyError if it's not in the graph.
+        """
+        task_id = self.name2id.get(name)
+        if task_id is None:
+            task_id = self.get_fused_name2id()[name]
+        return self.id2task[task_id]
+
+    def get_fused_name2id(self):
+        """Returns name of each task fused by optimize -> id of the FusedTask running it"""
+        fused_name2id = {}
+        for task_id, task in enumerate(self.id2task):
+            if isinstance(task, FusedTask):
+                for original in task.original_tasks:
+                    fused_name2id[original.name] = task_id
+        return fused_name2id
+
+    def get_waiting_for(self, task):
+        """Returns the list of tasks the task waits for"""
+        id2task = self.id2task
+        return [id2task[i] for i in self.id2waiting_for[self.get_task_id(task)]]
+
+    def get_dependents(self, task):
+        """Returns the list of tasks waiting for the task"""
+        id2task = self.id2task
+        return [id2task[i] for i in self.id2dependents[self.get_task_id(task)]]
 
     def add_task(self, task, waiting_for=None):
         """Add task to this graph
@@ -51,9 +309,11 @@ class TaskGraph:
         waiting_for : Task or list
             a task or a list of tasks to wait for
         """
-        if task not in self.tasks:
-            self.tasks.append(task)
-            self.task2waiting_for[task] = []
+        if task.name not in self.name2id:
+            self.name2id[task.name] = len(self.id2task)
+            self.id2task.append(task)
+            self.id2waiting_for.append({})
+            self.id2dependents.append({})
 
         if waiting_for:
             self.add_dependency(task, waiting_for)
@@ -66,6 +326,8 @@ class TaskGraph:
     def add_dependency(self, task, waiting_for):
         """Add execution dependency to this graph
 
+        Tasks not in the graph yet are added, an edge already in the graph is ignored.
+
         Parameters
         ----------
         task : Task
@@ -74,16 +336,44 @@ class TaskGraph:
             a task or a list of tasks to wait for
         """
         if isinstance(waiting_for, Task):
-            self.task2waiting_for[task].append(waiting_for)
+            waiting_for = [waiting_for]
+        if not isinstance(waiting_for, list):
+            return
 
-        if isinstance(waiting_for, list):
-            self.task2waiting_for[task] += waiting_for
+        self.add_task(task)
+        task_id = self.name2id[task.name]
+        waiting_for_ids = self.id2waiting_for[task_id]
+        for w in waiting_for:
+            self.add_task(w)
+            w_id = self.name2id[w.name]
+            if w_id not in waiting_for_ids:
+                waiting_for_ids[w_id] = None
+                self.id2dependents[w_id][task_id] = None
 
     def run(self,
             title='Demo',
             callback=None,
             log_formatter=None,
-            exit_on_success=False
+            exit_on_success=False,
+            max_workers=None,
+            backend=None,
+            policy='fifo',
+            durations=None,
+            resources=None,
+            cache=None,
+            journal=None,
+            resume=None,
+            max_output_memory=DEFAULT_MAX_MEMORY,
+            max_log_records=DEFAULT_MAX_RECORDS,
+            log_level='DEBUG',
+            log_rate_limit=None,
+            stdout_batch_size=None,
+            capture_fd=False,
+            min_frame_interval=0.05,
+            ui=True,
+            event_stream=None,
+            event_format='text',
+            targets=None
     ):
         """A hepler function to run this task graph
 
@@ -98,66 +388,498 @@ class TaskGraph:
             An instance of logging.Formatter. Defaults to gtui.utils.default_log_formatter.
         exit_on_success: boolean
             Whether exit TUI if all tasks succeed. Defaults to False.
+        max_workers: int
+            Maximum number of tasks running at the same time. Defaults to None meaning no limit.
+        backend: str or gtui.backend.Backend
+            'thread' runs tasks in a thread pool, 'process' runs tasks in worker processes.
+            Defaults to 'thread'.
+        policy: str
+            Order to start ready tasks when max_workers is reached. 'fifo' (default) starts tasks
+            in the order they become ready, 'priority' starts tasks with higher Task.priority first
+            and 'critical_path' starts tasks with the longest estimated path to the end first.
+        durations: dict
+            Task name -> seconds, e.g. measured in previous runs, used by 'critical_path' policy.
+            Falls back to Task.estimated_duration.
+        resources: dict
+            Resource name -> capacity, e.g. {'cpu': 32, 'db': 4}. A task only starts when the
+            resources in Task.resources can be acquired. Resources without capacity are not limited.
+        cache: bool, str or gtui.cache.ResultCache
+            Skip tasks whose function, arguments, Task.inputs files and upstream tasks are unchanged
+            since a cached successful run. True uses ~/.cache/gtui, a str specifies the directory.
+            Defaults to None meaning no cache.
+        journal: str
+            Path of a file to append status transitions of tasks to. Defaults to resume.
+        resume: str
+            Path of the journal of a previous run. Tasks succeeded in that run are not run again,
+            only failed or not finished tasks and the tasks waiting for them are run.
+        max_output_memory: int
+            Maximum number of characters of stdout kept in memory for each task, older output is
+            spilled to a temporary file. Defaults to gtui.output.DEFAULT_MAX_MEMORY, None means
+            no limit.
+        max_log_records: int
+            Maximum number of log records kept for each task, the oldest ones are dropped when
+            exceeded. Defaults to gtui.logstore.DEFAULT_MAX_RECORDS, None means no limit.
+        log_level: int or str
+            Log records below this level are not collected, for tasks without Task.log_level.
+            Defaults to 'DEBUG'.
+        log_rate_limit: float
+            Maximum log records per second collected below WARNING, for tasks without
+            Task.log_rate_limit. Defaults to None meaning no limit.
+        stdout_batch_size: int
+            Number of characters a task prints before they are written to its output in one batch.
+            Speeds up tasks printing many short lines but delays their output. Defaults to None.
+        capture_fd: boolean
+            With 'process' backend, capture file descriptors 1 & 2 of worker processes so output of
+            C extensions, os.system and child processes is shown in the task too. Defaults to False.
+        min_frame_interval: float
+            Minimum seconds between two refreshes of the TUI, which is refreshed when tasks change status
+            or the selected task writes output or log. Changes in between are shown together.
+        ui: boolean
+            Whether show the TUI. Defaults to True. If False, the graph is run by a
+            gtui.headless.HeadlessRunner and status changes of tasks are written to event_stream.
+        event_stream: file or str
+            File object or path to write status changes to when ui is False. Defaults to stderr.
+        event_format: str
+            'text' or 'json', format of status changes when ui is False. Defaults to 'text'.
+        targets: list
+            Tasks or task names to run, only they and the tasks they depend on are run and shown.
+            Defaults to None meaning all tasks.
+
+        Returns
+        -------
+        int
+            When ui is False, 0 if all tasks succeed, 1 if any task fails.
 
         Raises
         ------
         ValueError
             If there is a cycle in graph, the message describe the cycle with task names.
+            Or if a task needs more resource than the capacity, or a target is not in graph.
         """
-        from .visualizer import Visualizer
         from .utils import default_log_formatter
 
         if not log_formatter:
             log_formatter = default_log_formatter
 
-        cycle = self.has_cycle()
-        if cycle:
-            raise ValueError('Found circle in TaskGraph: ' + ' -> '.join([t.name for t in cycle]))
+        graph = self if targets is None else self.subgraph(targets)
+        graph.raise_for_cycle()
+
+        if not ui:
+            # The TUI & its dependencies are only imported when used
+            from .headless import HeadlessRunner
+
+            return HeadlessRunner(
+                graph=graph,
+                callback=callback,
+                stream=event_stream,
+                event_format=event_format,
+                max_workers=max_workers,
+                backend=backend,
+                policy=policy,
+                durations=durations,
+                resources=resources,
+                cache=cache,
+                journal=journal or resume,
+                resume=resume,
+                max_output_memory=max_output_memory,
+                max_log_records=max_log_records,
+                log_level=log_level,
+                log_rate_limit=log_rate_limit,
+                stdout_batch_size=stdout_batch_size,
+                capture_fd=capture_fd
+            ).run()
+
+        from .visualizer import Visualizer
 
         Visualizer(
-            graph=self,
+            graph=graph,
             title=title,
             callback=callback,
             log_formatter=log_formatter,
-            exit_on_success=exit_on_success
+            exit_on_success=exit_on_success,
+            max_workers=max_workers,
+            backend=backend,
+            policy=policy,
+            durations=durations,
+            resources=resources,
+            cache=cache,
+            journal=journal or resume,
+            resume=resume,
+            max_output_memory=max_output_memory,
+            max_log_records=max_log_records,
+            log_level=log_level,
+            log_rate_limit=log_rate_limit,
+            stdout_batch_size=stdout_batch_size,
+            capture_fd=capture_fd,
+            min_frame_interval=min_frame_interval
         ).run()
 
     def has_task(self, task):
         """Whether a task is in this graph"""
-        return task in self.tasks
+        return task.name in self.name2id
+
+    def closure_ids(self, task_ids, id2neighbors):
+        """Returns ids of given tasks and tasks reachable from them in a breadth first search"""
+        selected = set(task_ids)
+        queue = list(selected)
+        for i in queue:
+            for j in id2neighbors[i]:
+                if j not in selected:
+                    selected.add(j)
+                    queue.append(j)
+        return selected
+
+    def subgraph(self, targets, include_downstream=False):
+        """Returns a graph of the targets and the tasks they wait for, directly or not
+
+        Parameters
+        ----------
+        targets : list
+            Task instances or task names
+        include_downstream : bool
+            whether also include the tasks waiting for the targets, directly or not,
+            along with the tasks they wait for so that they can run
+
+        Raises
+        ------
+        ValueError
+            if a target is not in this graph
+        """
+        target_ids = []
+        fused_name2id = None
+        for target in targets:
+            name = target if isinstance(target, str) else target.name
+            task_id = self.name2id.get(name)
+            if task_id is None:
+                # The target may have been fused by optimize, the whole FusedTask is needed
+                if fused_name2id is None:
+                    fused_name2id = self.get_fused_name2id()
+                task_id = fused_name2id.get(name)
+            if task_id is None:
+                raise ValueError('Unknown task {!r}'.format(name))
+            target_ids.append(task_id)
+
+        if include_downstream:
+            target_ids = self.closure_ids(target_ids, self.id2dependents)
+        selected = sorted(self.closure_ids(target_ids, self.id2waiting_for))
+
+        id2task = self.id2task
+        edges = [(id2task[i], id2task[w]) for i in selected for w in self.id2waiting_for[i]]
+        return type(self).from_edges([id2task[i] for i in selected], edges)
+
+    def optimize(self, fuse_below=None, durations=None):
+        """Simplify this graph in place before running it, returns what was removed.
+
+        Edges implied by other edges are removed, e.g. C waiting for A when C
+        waits for B which waits for A. Then if fuse_below is given, linear
+        chains of short tasks, where each one is the only task waiting for the
+        previous one and waits for nothing else, are replaced by a FusedTask
+        running them in one dispatch. Only tasks with the same log options are
+        fused. ShellTask and tasks of async functions are never fused, so that
+        they still run on the shell & asyncio backends.
+
+        A FusedTask is named after its first & last task, e.g. 'a..c', and it's
+        shown under this name in the TUI & events. The names of the tasks fused
+        still work as targets of run & subgraph, which select the FusedTask, in
+        durations given to run, and in journals, which record them instead of
+        the name of the FusedTask.
+
+        Removing edges searches the upstream of each task having several direct
+        dependencies, it's fast when edges link nearby tasks but may take seconds
+        on large graphs where tasks wait for tasks far upstream.
+
+        Parameters
+        ----------
+        fuse_below : float
+            tasks estimated to run for less seconds than it can be fused. Defaults to None,
+            meaning no fusion.
+        durations : dict
+            task name -> seconds, falls back to Task.estimated_duration. A task without an
+            estimation is not fused.
+
+        Returns
+        -------
+        dict
+            'removed_edges' : number of redundant edges removed,
+            'removed_dispatches' : number of tasks less to dispatch after fusion
+
+        Raises
+        ------
+        ValueError
+            if the graph contains a cycle
+        """
+        order = self.topological_order_ids()
+        if len(order) < len(self.id2task):
+            self.raise_for_cycle()
+
+        removed_edges = self.remove_redundant_edges(order)
+        removed_dispatches = 0
+        if fuse_below is not None:
+            removed_dispatches = self.fuse_chains(order, fuse_below, durations or {})
+        return {'removed_edges': removed_edges, 'removed_dispatches': removed_dispatches}
+
+    def remove_redundant_edges(self, order):
+        """Transitive reduction given ids in topological order, returns the number of edges removed"""
+        position = [0] * len(order)
+        for i, task_id in enumerate(order):
+            position[task_id] = i
+
+        id2waiting_for, id2dependents = self.id2waiting_for, self.id2dependents
+        # Task id -> id of the last task whose search visited it, saves clearing a visited set
+        visited_by = [-1] * len(order)
+        num_removed = 0
+        for task_id in order:
+            waiting_for = id2waiting_for[task_id]
+            if len(waiting_for) < 2:
+                continue
+
+            # Search upstream of the direct dependencies, those visited are redundant.
+            # Tasks before the earliest one in topological order can't lead to any of them.
+            lowest = min(position[w] for w in waiting_for)
+            stack = [u for w in waiting_for for u in id2waiting_for[w]]
+            while stack:
+                u = stack.pop()
+                if visited_by[u] == task_id:
+                    continue
+                visited_by[u] = task_id
+                if position[u] > lowest:
+                    stack.extend(id2waiting_for[u])
+
+            redundant = [w for w in waiting_for if visited_by[w] == task_id]
+            for w in redundant:
+                del waiting_for[w]
+                del id2dependents[w][task_id]
+            num_removed += len(redundant)
+        return num_removed
+
+    def fuse_chains(self, order, fuse_below, durations):
+        """Replace linear chains of short tasks by FusedTask, returns the number of tasks removed"""
+        id2task, id2waiting_for, id2dependents = self.id2task, self.id2waiting_for, self.id2dependents
+
+        def can_fuse(task):
+            # ShellTask & async tasks run on their own backends, a FusedTask runs on the main one
+            if isinstance(task, ShellTask) or task.is_async:
+                return False
+            duration = durations.get(task.name, task.estimated_duration)
+            return duration is not None and duration < fuse_below
+
+        # Task id -> id of the first task of the chain it's fused into
+        id2head = list(range(len(id2task)))
+        head2chain = {}
+        for task_id in order:
+            task = id2task[task_id]
+            if len(id2waiting_for[task_id]) != 1 or not can_fuse(task):
+                continue
+            previous = next(iter(id2waiting_for[task_id]))
+            previous_task = id2task[previous]
+            if (len(id2dependents[previous]) == 1 and can_fuse(previous_task)
+                    and previous_task.log_level == task.log_level
+                    and previous_task.log_rate_limit == task.log_rate_limit):
+                head = id2head[previous]
+                id2head[task_id] = head
+                head2chain.setdefault(head, [previous]).append(task_id)
+
+        if not head2chain:
+            return 0
+
+        tasks = []
+        head2task = {}
+        for task_id, task in enumerate(id2task):
+            if id2head[task_id] != task_id:
+                continue
+            if task_id in head2chain:
+                task = FusedTask([id2task[i] for i in head2chain[task_id]])
+            head2task[task_id] = task
+            tasks.append(task)
+
+        edges = [(head2task[id2head[task_id]], head2task[id2head[w]])
+                 for task_id in range(len(id2task)) for w in id2waiting_for[task_id]
+                 if id2head[task_id] != id2head[w]]
+        graph = type(self).from_edges(tasks, edges)
+        self.name2id, self.id2task = graph.name2id, graph.id2task
+        self.id2waiting_for, self.id2dependents = graph.id2waiting_for, graph.id2dependents
+        return len(id2task) - len(tasks)
 
     def has_cycle(self):
-        """Returns a list of tasks contained in a cycle if there is one or None if no cycle."""
-        cycle = None
-
-        task2visited = {t: False for t in self.tasks}
-        task2on_stack = {t: False for t in self.tasks}
-        task2on_stack_dep = {t: None for t in self.tasks}
-
-        def dfs(t):
-            nonlocal cycle
-            task2visited[t] = True
-            task2on_stack[t] = True
-            for w in self.task2waiting_for[t]:
-                if cycle:
-                    return
-                elif not task2visited[w]:
-                    task2on_stack_dep[t] = w
-                    dfs(w)
-                elif task2on_stack[w]:
-                    cycle = []
-                    v = w
-                    while v != t:
-                        cycle.append(v)
-                        v = task2on_stack_dep[v]
-                    cycle += [t, w]
-            task2on_stack[t] = False
-
-        for t in self.tasks:
-            if not task2visited[t]:
-                dfs(t)
-
-        return cycle
+        """Returns a list of tasks contained in a cycle if there is one or None if no cycle.
+
+        The list starts and ends with the same task, each task in it waits for the next one.
+        """
+        n = len(self.id2task)
+        id2waiting_for = self.id2waiting_for
+        visited = bytearray(n)
+        on_stack = bytearray(n)
+        on_stack_dep = [-1] * n
+
+        # Depth first search with an explicit stack of (task id, iterator of ids it waits for),
+        # so that long chains don't hit the recursion limit
+        for root in range(n):
+            if visited[root]:
+                continue
+            visited[root] = on_stack[root] = 1
+            stack = [(root, iter(id2waiting_for[root]))]
+            while stack:
+                t, waiting_for = stack[-1]
+                for w in waiting_for:
+                    if not visited[w]:
+                        on_stack_dep[t] = w
+                        visited[w] = on_stack[w] = 1
+                        stack.append((w, iter(id2waiting_for[w])))
+                        break
+                    elif on_stack[w]:
+                        cycle = []
+                        v = w
+                        while v != t:
+                            cycle.append(v)
+                            v = on_stack_dep[v]
+                        cycle += [t, w]
+                        return [self.id2task[i] for i in cycle]
+                else:
+                    on_stack[t] = 0
+                    stack.pop()
+
+        return None
+
+    def topological_order_ids(self):
+        """Returns task ids ordered so that each task comes after the tasks it waits for.
+
+        Tasks are taken in insertion order when there's a choice. Tasks in or
+        behind a cycle are left out, so the result is shorter than the graph.
+        """
+        id2dependents = self.id2dependents
+        remaining = [len(w) for w in self.id2waiting_for]
+        order = [i for i, r in enumerate(remaining) if r == 0]
+        for i in order:
+            for d in id2dependents[i]:
+                remaining[d] -= 1
+                if remaining[d] == 0:
+                    order.append(d)
+        return order
+
+    def topological_order(self):
+        """Returns tasks ordered so that each task comes after the tasks it waits for
+
+        Raises
+        ------
+        ValueError
+            if the graph contains a cycle
+        """
+        order = self.topological_order_ids()
+        if len(order) < len(self.id2task):
+            self.raise_for_cycle()
+        id2task = self.id2task
+        return [id2task[i] for i in order]
+
+    def levels(self):
+        """Returns tasks grouped by depth, a list of lists.
+
+        Tasks in level 0 wait for nothing and tasks in level k wait for some
+        task in level k - 1, so tasks of the same level can run in parallel.
+
+        Raises
+        ------
+        ValueError
+            if the graph contains a cycle
+        """
+        order = self.topological_order_ids()
+        if len(order) < len(self.id2task):
+            self.raise_for_cycle()
+
+        id2waiting_for = self.id2waiting_for
+        depths = [0] * len(order)
+        levels = []
+        for i in order:
+            depth = 0
+            for w in id2waiting_for[i]:
+                if depths[w] >= depth:
+                    depth = depths[w] + 1
+            depths[i] = depth
+            if depth == len(levels):
+                levels.append([])
+            levels[depth].append(self.id2task[i])
+        return levels
+
+    def raise_for_cycle(self):
+        """Raise ValueError describing a cycle if the graph contains one"""
+        cycle = self.has_cycle()
+        if cycle:
+            raise ValueError('Found circle in TaskGraph: ' + ' -> '.join([t.name for t in cycle]))
+
+    @classmethod
+    def from_edges(cls, tasks, edges):
+        """Create a graph from a list of tasks and a list of dependencies at once
+
+        Parameters
+        ----------
+        tasks : list
+            tasks of the graph, their names must be unique
+        edges : list
+            (task, waiting_for) pairs meaning task waits for waiting_for. Each of them is
+            a Task or a task name. Tasks not in tasks are added, duplicated edges are ignored.
+
+        Raises
+        ------
+        ValueError
+            if a task name is duplicated or an edge refers to an unknown task name
+        """
+        graph = cls()
+        name2id = graph.name2id
+        for task in tasks:
+            if task.name in name2id:
+                raise ValueError('Duplicated task name {!r}'.format(task.name))
+            name2id[task.name] = len(graph.id2task)
+            graph.id2task.append(task)
+        graph.id2waiting_for = [{} for _ in graph.id2task]
+        graph.id2dependents = [{} for _ in graph.id2task]
+
+        def get_id(task):
+            if isinstance(task, str):
+                task_id = name2id.get(task)
+                if task_id is None:
+                    raise ValueError('Unknown task {!r}'.format(task))
+                return task_id
+            task_id = name2id.get(task.name)
+            if task_id is None:
+                graph.add_task(task)
+                task_id = name2id[task.name]
+            return task_id
+
+        id2waiting_for, id2dependents = graph.id2waiting_for, graph.id2dependents
+        for task, waiting_for in edges:
+            task_id, waiting_for_id = get_id(task), get_id(waiting_for)
+            id2waiting_for[task_id][waiting_for_id] = None
+            id2dependents[waiting_for_id][task_id] = None
+        return graph
+
+    @classmethod
+    def from_dict(cls, dependencies, tasks=None):
+        """Create a graph from a dict of task -> list of tasks it waits for
+
+        Parameters
+        ----------
+        dependencies : dict
+            keys and the tasks in values are Task instances or task names, e.g.
+            {'report': ['fetch', 'clean'], 'clean': ['fetch']}
+        tasks : list
+            tasks to look names up, tasks which are keys of dependencies needn't be in it
+
+        Raises
+        ------
+        ValueError
+            if a task name is duplicated or unknown
+        """
+        tasks = list(tasks or [])
+        names = {t.name for t in tasks}
+        for task in dependencies:
+            if isinstance(task, Task) and task.name not in names:
+                tasks.append(task)
+                names.add(task.name)
+        edges = [(task, w) for task, waiting_for in dependencies.items() for w in waiting_for]
+        graph = cls.from_edges(tasks, edges)
+        for task in dependencies:
+            if isinstance(task, str) and task not in graph.name2id:
+                raise ValueError('Unknown task {!r}'.format(task))
+        return graph
 
     @classmethod
     def linear_graph_from_list(cls, tasks):
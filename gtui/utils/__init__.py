@@ -4,3 +4,15 @@ default_log_formatter = logging.Formatter(
     fmt='[%(asctime)-15s][%(name)s][%(message)s]',
     datefmt='%Y-%m-%d %H:%M:%S'
 )
+
+
+def picklable_log_record(record: logging.LogRecord):
+    """Returns a copy of record with message formatted and args & exc_info dropped"""
+    record = logging.makeLogRecord(record.__dict__)
+    record.msg = record.getMessage()
+    record.args = None
+    if record.exc_info:
+        if not record.exc_text:
+            record.exc_text = default_log_formatter.formatException(record.exc_info)
+        record.exc_info = None
+    return record
@@ -0,0 +1,118 @@
+"""Text widgets suited to show output which keeps growing"""
+import urwid
+from urwid.widget import BOX
+
+
+class TextLines:
+    """Lines of a text kept in a list, new text can be appended to it"""
+
+    def __init__(self, text=''):
+        self.lines = text.split('\n')
+
+    def append_text(self, text):
+        if not text:
+            return
+        lines = text.split('\n')
+        self.lines[-1] += lines[0]
+        self.lines.extend(lines[1:])
+
+    def __len__(self):
+        return len(self.lines)
+
+    def get_lines(self, start, stop):
+        """Returns lines in [start, stop)"""
+        return self.lines[start:stop]
+
+
+class LinesViewer(urwid.Widget):
+    """A box widget showing a window of lines, compatible with urwid_scroll.ScrollBar.
+
+    Lines are read from a source providing __len__ and get_lines(start, stop),
+    e.g. TextLines or gtui.output.LineIndex. Only the lines on screen are read
+    and laid out, so rendering and scrolling cost the same however many lines
+    there are. The scroll position counts lines rather than rows, a negative
+    position is counted from the bottom.
+    """
+
+    _sizing = frozenset([BOX])
+    _selectable = True
+
+    def __init__(self, source=None):
+        self.source = source if source is not None else TextLines()
+        self.top = 0
+        self.rendered_top = 0
+
+    def set_source(self, source):
+        self.source = source
+        self.top = 0
+        self._invalidate()
+
+    def refresh(self):
+        """Redraw on next render, call it when the source has changed"""
+        self._invalidate()
+
+    def get_top(self, maxrow):
+        """Returns the index of the first line to show for maxrow rows"""
+        num_lines = len(self.source)
+        if self.top < 0:
+            return max(0, num_lines + self.top + 1 - maxrow)
+        return max(0, min(self.top, num_lines - maxrow))
+
+    def render(self, size, focus=False):
+        maxcol, maxrow = size
+        top = self.get_top(maxrow)
+        follow = self.top < 0 or top + maxrow >= len(self.source)
+        self.rendered_top = top
+
+        # Each line takes at least one row, so maxrow lines are enough to fill the screen
+        lines = self.source.get_lines(top, top + maxrow)
+        canv = urwid.CompositeCanvas(urwid.Text('\n'.join(lines)).render((maxcol,)))
+        rows = canv.rows()
+        if rows > maxrow:
+            # Long lines are wrapped, keep the bottom rows when showing the last lines
+            if follow:
+                canv.trim(rows - maxrow)
+            else:
+                canv.trim_end(rows - maxrow)
+        elif rows < maxrow:
+            canv.pad_trim_top_bottom(0, maxrow - rows)
+        return canv
+
+    def keypress(self, size, key):
+        maxcol, maxrow = size
+        top = self.get_top(maxrow)
+        command = self._command_map[key]
+        if command == urwid.CURSOR_UP:
+            top -= 1
+        elif command == urwid.CURSOR_DOWN:
+            top += 1
+        elif command == urwid.CURSOR_PAGE_UP:
+            top -= maxrow - 1
+        elif command == urwid.CURSOR_PAGE_DOWN:
+            top += maxrow - 1
+        elif command == urwid.CURSOR_MAX_LEFT:
+            top = 0
+        elif command == urwid.CURSOR_MAX_RIGHT:
+            self.set_scrollpos(-1)
+            return key
+        else:
+            return key
+
+        self.set_scrollpos(max(0, top))
+        return key
+
+    def get_scrollpos(self, size=None, focus=False):
+        """Index of the first visible line"""
+        if size is not None:
+            return self.get_top(size[1])
+        return self.rendered_top
+
+    def set_scrollpos(self, position):
+        """Set index of the first visible line, negative values count from the bottom"""
+        if self.top != int(position):
+            self.top = int(position)
+            self._invalidate()
+
+    def rows_max(self, size=None, focus=False):
+        """Number of lines, as long lines are not counted as multiple rows"""
+        return len(self.source)
@@ -5,16 +5,21 @@ It's based on the awesome lib urwid. It uses the
 executor implemented in gtui.executor to execute
 the tasks and track the output & logs of each task.
 """
+import os
+import time
 import string
 import logging
+import threading
 
 import urwid
-import pyperclip
 from additional_urwid_widgets.widgets.indicative_listbox import IndicativeListBox
 
 from .task import Task, TaskStatus, TaskGraph
 from .executor import Executor
+from .output import DEFAULT_MAX_MEMORY, LineIndex
+from .logstore import DEFAULT_MAX_RECORDS
 from .utils import urwid_scroll
+from .utils import urwid_text
 from .utils import default_log_formatter
 
 logger = logging.getLogger(__name__)
@@ -30,13 +35,16 @@ class Tab:
     UNICODE_CROSS = '\U00002717'
     UNICODE_CHECK_MARK = '\U00002713'
     UNICODE_SPINNER_LIST = ["⣾", "⣽", "⣻", "⢿", "⡿", "⣟", "⣯", "⣷"]
+    SPINNER_INTERVAL = 0.5
 
     def __init__(self, widget: urwid.Text, log_formatter=default_log_formatter):
         self.widget = widget
         self.selected = False
         self.focus_on_log = False
-        self.spinner_index = 0
-        self.log_formatter = log_formatter
+
+        # Formatted log lines are cached, only records added since last update are formatted
+        self._log_formatter = log_formatter
+        self.clear_log_lines()
 
     def toggle_focus(self):
         self.focus_on_log = not self.focus_on_log
@@ -47,18 +55,22 @@ class Tab:
             status=self.tab_status_str,
             name=self.name
         )
-        self.widget.set_text(txt)
+        # Setting text invalidates the layout of the widget, avoid it if nothing changes
+        if txt != self.widget.text:
+            self.widget.set_text(txt)
 
     @property
     def tab_status_str(self):
         """str : represents the current task status"""
-        if self.status == TaskStatus.Success:
+        status = self.status
+        if status == TaskStatus.Success:
             return self.UNICODE_CHECK_MARK
-        if self.status == TaskStatus.Failure:
+        if status == TaskStatus.Failure:
             return self.UNICODE_CROSS
-        if self.status == TaskStatus.Running:
-            self.spinner_index = (self.spinner_index + 1) % len(self.UNICODE_SPINNER_LIST)
-            return self.UNICODE_SPINNER_LIST[self.spinner_index]
+        if status == TaskStatus.Running:
+            # Spinner moves with time, no matter how often the tab is refreshed
+            spinner_index = int(time.monotonic() / self.SPINNER_INTERVAL) % len(self.UNICODE_SPINNER_LIST)
+            return self.UNICODE_SPINNER_LIST[spinner_index]
         return ' '
 
     @property
@@ -67,12 +79,50 @@ class Tab:
 
     @property
     def log_output(self):
-        return'\n'.join([self.log_formatter.format(r) for r in self.records])
+        self.update_log_lines()
+        return '\n'.join(self.log_lines.lines)
+
+    @property
+    def log_formatter(self):
+        """logging.Formatter : formatter of log records, setting it clears formatted lines"""
+        return self._log_formatter
+
+    @log_formatter.setter
+    def log_formatter(self, log_formatter):
+        self._log_formatter = log_formatter
+        self.clear_log_lines()
+
+    def clear_log_lines(self, start=0):
+        """Clear formatted lines, records are formatted again from index start"""
+        self.log_lines = urwid_text.TextLines()
+        self.log_lines_start = start
+        self.num_formatted_records = start
+
+    def update_log_lines(self):
+        """Format records added since last update, returns whether there's any"""
+        # Drop lines of records dropped by the log collector as well
+        num_dropped = self.num_dropped_records
+        if num_dropped > self.log_lines_start:
+            self.clear_log_lines(num_dropped)
+
+        records, end = self.read_records_since(self.num_formatted_records)
+        if not records:
+            return False
+        text = '\n'.join([self.log_formatter.format(r) for r in records])
+        if self.num_formatted_records > self.log_lines_start:
+            text = '\n' + text
+        self.log_lines.append_text(text)
+        self.num_formatted_records = end
+        return True
 
     @property
     def output(self):
         """str : output of the sidebar task"""
 
+    @property
+    def output_lines(self):
+        """gtui.output.LineIndex : an index over lines of the output"""
+
     @property
     def name(self):
         """str : display name of the sidebar item"""
@@ -82,8 +132,20 @@ class Tab:
         """str : one of the enums defined in TaskStatus"""
 
     @property
-    def records(self):
-        """Return a list of log records"""
+    def num_dropped_records(self):
+        """int : number of the oldest log records dropped by the log collector"""
+        return 0
+
+    @property
+    def num_suppressed_records(self):
+        """int : number of log records rejected by level or rate limit"""
+        return 0
+
+    def read_records_since(self, start):
+        """Returns log records from index start and the index after them"""
+
+    def watch(self, listener):
+        """Call listener without arguments when output or log changes, None to stop"""
 
 
 class TaskTab(Tab):
@@ -92,6 +154,7 @@ class TaskTab(Tab):
         super().__init__(urwid.Text(''), log_formatter)
         self.task = task
         self.executor = executor
+        self.line_index = LineIndex(executor.task2stdout[task])
         self.update_display()
 
     @property
@@ -107,8 +170,43 @@ class TaskTab(Tab):
         return self.executor.get_task_output(self.task)
 
     @property
-    def records(self):
-        return self.executor.get_task_log_records(self.task)
+    def output_lines(self):
+        return self.line_index
+
+    @property
+    def num_dropped_records(self):
+        return self.executor.get_task_num_dropped_log_records(self.task)
+
+    @property
+    def num_suppressed_records(self):
+        return self.executor.get_task_num_suppressed_log_records(self.task)
+
+    def read_records_since(self, start):
+        return self.executor.read_task_log_records_since(self.task, start)
+
+    def watch(self, listener):
+        self.executor.set_task_listener(self.task, listener)
+
+
+class SidebarListBox(IndicativeListBox):
+    """An IndicativeListBox which remembers positions of items visible when last rendered"""
+
+    def __init__(self, body, **kwargs):
+        super().__init__(body, **kwargs)
+        self.visible_positions = range(0)
+
+    def render(self, size, focus=False):
+        canvas = super().render(size, focus)
+
+        maxcol, maxrow = size
+        maxrow -= self._top_bar.rows((maxcol,)) + self._bottom_bar.rows((maxcol,))
+        middle, top, bottom = self._listbox.calculate_visible((maxcol, maxrow), focus=focus)
+        if middle is None:
+            self.visible_positions = range(0)
+        else:
+            positions = [middle[2]] + [pos for _, pos, _ in top[1]] + [pos for _, pos, _ in bottom[1]]
+            self.visible_positions = range(min(positions), max(positions) + 1)
+        return canvas
 
 
 class Visualizer:
@@ -131,7 +229,11 @@ class Visualizer:
         (P_KEY, "Q"), " : exits",
     ]
 
-    def __init__(self, graph: TaskGraph, log_formatter, title, callback=None, exit_on_success=False):
+    def __init__(self, graph: TaskGraph, log_formatter, title, callback=None, exit_on_success=False,
+                 max_workers=None, backend=None, policy='fifo', durations=None, resources=None,
+                 cache=None, journal=None, resume=None, max_output_memory=DEFAULT_MAX_MEMORY,
+                 max_log_records=DEFAULT_MAX_RECORDS, log_level=logging.DEBUG, log_rate_limit=None,
+                 stdout_batch_size=None, capture_fd=False, min_frame_interval=0.05):
         """Init a visualizer with the task graph and other options.
 
         Parameters
@@ -145,16 +247,70 @@ class Visualizer:
             An instance of logging.Formatter. Defaults to gtui.utils.default_log_formatter.
         exit_on_success: boolean
             Whether exit TUI if all tasks succeed. Defaults to False.
+        max_workers: int
+            Maximum number of tasks running at the same time. Defaults to None meaning no limit.
+        backend: str or gtui.backend.Backend
+            'thread' runs tasks in a thread pool, 'process' runs tasks in worker processes.
+            Defaults to 'thread'.
+        policy: str
+            Order to start ready tasks, 'fifo', 'priority' or 'critical_path'. Defaults to 'fifo'.
+        durations: dict
+            Task name -> seconds, used by 'critical_path' policy.
+        resources: dict
+            Resource name -> capacity, limits tasks running at the same time by Task.resources.
+        cache: bool, str or gtui.cache.ResultCache
+            Skip tasks whose inputs are unchanged since a cached successful run.
+        journal: str or gtui.journal.Journal
+            Path of a file to append status transitions of tasks to.
+        resume: str
+            Path of the journal of a previous run, tasks succeeded in that run are not run again.
+        max_output_memory: int
+            Maximum number of characters of stdout kept in memory for each task, None means no limit.
+        max_log_records: int
+            Maximum number of log records kept for each task, None means no limit.
+        log_level: int or str
+            Log records below this level are not collected, for tasks without Task.log_level.
+        log_rate_limit: float
+            Maximum log records per second collected below WARNING, for tasks without
+            Task.log_rate_limit.
+        stdout_batch_size: int
+            Number of characters a task prints before they are written to its output in one batch.
+        capture_fd: bool
+            Whether capture file descriptors 1 & 2 of 'process' backend workers.
+        min_frame_interval: float
+            Minimum seconds between two refreshes of the UI, changes in between are shown together.
         """
         self.graph = graph
         self.callback = callback
         self.exit_on_success = exit_on_success
         self.need_exit = False
-        self.executor = Executor(graph, callback=self.wrapped_callback)
+        self.executor = Executor(
+            graph,
+            callback=self.wrapped_callback,
+            max_workers=max_workers,
+            backend=backend,
+            policy=policy,
+            durations=durations,
+            resources=resources,
+            cache=cache,
+            journal=journal,
+            resume=resume,
+            max_output_memory=max_output_memory,
+            max_log_records=max_log_records,
+            log_level=log_level,
+            log_rate_limit=log_rate_limit,
+            stdout_batch_size=stdout_batch_size,
+            capture_fd=capture_fd
+        )
 
         self.tabs = [TaskTab(t, self.executor, log_formatter) for t in graph.tasks]
+        self.task2tab = {tab.task: tab for tab in self.tabs}
+        # Tabs to update when the sidebar is refreshed, added from other threads
+        self.dirty_tabs = set()
+        self.dirty_tabs_lock = threading.Lock()
         self.selected_index = 0
         self.tabs[0].selected = True
+        self.mark_dirty(self.tabs[0])
         self.min_index = 0
         self.max_index = len(self.tabs) - 1
 
@@ -163,9 +319,8 @@ class Visualizer:
         #################
 
         # Main Display
-        self.txt = urwid.Text('')
-        self.scroll = urwid_scroll.Scrollable(self.txt)
-        self.scroll_bar = urwid_scroll.ScrollBar(self.scroll)
+        self.txt = urwid_text.LinesViewer()
+        self.scroll_bar = urwid_scroll.ScrollBar(self.txt)
         self.main_display = urwid.LineBox(self.scroll_bar, title='Output', title_align='left')
         self.should_follow_txt = True
 
@@ -179,7 +334,7 @@ class Visualizer:
 
         # SideBar
         self.sidebar_items = [tab.widget for tab in self.tabs]
-        self.tab_box = IndicativeListBox(self.sidebar_items)
+        self.tab_box = SidebarListBox(self.sidebar_items)
         self.sidebar = urwid.LineBox(self.tab_box, title='Task', title_align='left')
 
         # Topmost Frame
@@ -201,6 +356,16 @@ class Visualizer:
             handle_mouse=False
         )
 
+        # The UI is refreshed when woken up by changes of task status and the selected task,
+        # at most once per min_frame_interval
+        self.min_frame_interval = min_frame_interval
+        self.wakeup_fd = self.loop.watch_pipe(self.on_wakeup)
+        self.is_wakeup_pending = False
+        self.last_frame_time = 0
+        self.frame_alarm = None
+        self.spinner_alarm = None
+        self.executor.scheduler.add_listener(self.on_status_change)
+
     def handle_input(self, key):
         if key == 'j':
             self.set_selected_tab(min(self.max_index, self.selected_index + 1))
@@ -220,6 +385,8 @@ class Visualizer:
             raise urwid.ExitMainLoop()
 
         if key == 'y':
+            import pyperclip  # Imported lazily, only needed when copying
+
             output = self.get_selected_tab().text
             pyperclip.copy(output)
 
@@ -238,25 +405,72 @@ class Visualizer:
 
     def set_selected_tab(self, index):
         self.tabs[self.selected_index].selected = False
+        self.tabs[self.selected_index].watch(None)
+        self.mark_dirty(self.tabs[self.selected_index])
         self.selected_index = index
         self.tabs[self.selected_index].selected = True
+        self.tabs[self.selected_index].watch(self.notify)
+        self.mark_dirty(self.tabs[self.selected_index])
         self.tab_box.select_item(self.selected_index)
 
+    def mark_dirty(self, tab):
+        """Update display of tab when the sidebar is refreshed next time"""
+        with self.dirty_tabs_lock:
+            self.dirty_tabs.add(tab)
+
+    def on_status_change(self, task, status):
+        self.mark_dirty(self.task2tab[task])
+        self.notify()
+
+    def set_log_formatter(self, log_formatter):
+        """Use another formatter for log records, they are formatted again when shown"""
+        for tab in self.tabs:
+            tab.log_formatter = log_formatter
+
     def refresh_main_display(self):
         sb_display = self.tabs[self.selected_index]
-        self.txt.set_text(sb_display.text)
+
+        # Only lines on screen are read when the viewer renders
+        if sb_display.focus_on_log:
+            changed = sb_display.update_log_lines()
+            lines = sb_display.log_lines
+        else:
+            changed = sb_display.output_lines.update()
+            lines = sb_display.output_lines
+        if lines is not self.txt.source:
+            self.txt.set_source(lines)
+        elif changed:
+            self.txt.refresh()
 
         if sb_display.focus_on_log:
-            self.main_display.set_title('  Output | * Log')
+            notes = []
+            if sb_display.num_suppressed_records:
+                notes.append('{} suppressed'.format(sb_display.num_suppressed_records))
+            if sb_display.num_dropped_records:
+                notes.append('{} oldest dropped'.format(sb_display.num_dropped_records))
+            if notes:
+                self.main_display.set_title('  Output | * Log ({})'.format(', '.join(notes)))
+            else:
+                self.main_display.set_title('  Output | * Log')
         else:
             self.main_display.set_title('* Output |   Log')
 
         if self.should_follow_txt:
-            self.scroll.set_scrollpos(-1)
+            self.txt.set_scrollpos(-1)
 
     def refresh_tab_display(self):
-        for tab in self.tabs:
+        """Update tabs whose task status or selection changed and spinners of visible tabs"""
+        with self.dirty_tabs_lock:
+            dirty_tabs, self.dirty_tabs = self.dirty_tabs, set()
+        for tab in dirty_tabs:
             tab.update_display()
+        self.refresh_spinners()
+
+    def refresh_spinners(self):
+        for position in self.tab_box.visible_positions:
+            tab = self.tabs[position]
+            if tab.status == TaskStatus.Running:
+                tab.update_display()
 
     def refresh_footer_display(self):
         text_content = [
@@ -278,13 +492,40 @@ class Visualizer:
         self.refresh_main_display()
         self.refresh_footer_display()
 
-    def refresh_ui_every_half_second(self, loop=None, data=None):
+    def notify(self, *args):
+        """Wake up the main loop to refresh the UI, can be called from any thread"""
+        if not self.is_wakeup_pending:
+            self.is_wakeup_pending = True
+            os.write(self.wakeup_fd, b'\0')
+
+    def on_wakeup(self, data):
+        if self.frame_alarm is None:
+            delay = self.last_frame_time + self.min_frame_interval - time.monotonic()
+            if delay > 0:
+                self.frame_alarm = self.loop.set_alarm_in(delay, self.refresh_frame)
+            else:
+                self.refresh_frame()
+        return True
+
+    def refresh_frame(self, loop=None, data=None):
+        # Changes from now on wake up the main loop again
+        self.frame_alarm = None
+        self.is_wakeup_pending = False
+        self.last_frame_time = time.monotonic()
         self.refresh_ui()
 
         if self.need_exit:
             raise urwid.ExitMainLoop()
 
-        self.loop.set_alarm_in(0.5, self.refresh_ui_every_half_second)
+        if self.spinner_alarm is None and self.executor.scheduler.num_running:
+            self.spinner_alarm = self.loop.set_alarm_in(Tab.SPINNER_INTERVAL, self.animate_spinners)
+
+    def animate_spinners(self, loop=None, data=None):
+        """Refresh the sidebar periodically while some tasks are running"""
+        self.spinner_alarm = None
+        if self.executor.scheduler.num_running:
+            self.refresh_spinners()
+            self.spinner_alarm = self.loop.set_alarm_in(Tab.SPINNER_INTERVAL, self.animate_spinners)
 
     def wrapped_callback(self, is_success):
         if self.callback:
@@ -292,9 +533,14 @@ class Visualizer:
 
         if is_success and self.exit_on_success:
             self.need_exit = True
+            self.notify()
 
     def run(self):
+        self.get_selected_tab().watch(self.notify)
         self.executor.start_execution()
         self.refresh_footer_display()
-        self.refresh_ui_every_half_second()
-        self.loop.run()
+        self.refresh_frame()
+        try:
+            self.loop.run()
+        finally:
+            self.executor.close_outputs()
@@ -7,5 +7,14 @@ setup(
         'urwid>=2.0.0',
         'additional-urwid-widgets==0.4.1',
         'pyperclip>=1.7.0'
-    ]
+    ],
+    extras_require={
+        'yaml': ['PyYAML'],
+        'toml': ['tomli; python_version < "3.11"'],
+    },
+    entry_points={
+        'console_scripts': [
+            'gtui = gtui.cli:main',
+        ]
+    }
 )